@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Response decoding benchmarks. Run with: make bench
+"""
+
+import pytest
+from esmcheckds2.esmcheckds2 import ESM, dehexify
+from benchmarks.payloads import (SIZES, devtree_response, device_rows,
+                                 encode_rows)
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_format_resp(benchmark, rows):
+    body = devtree_response(rows)
+    resp = benchmark(ESM._format_resp, body)
+    assert resp['ITEMS'].count('\n') == rows
+
+
+@pytest.mark.parametrize('hexen', [False, True], ids=['uri', 'hexen'])
+@pytest.mark.parametrize('rows', SIZES)
+def test_dehexify(benchmark, rows, hexen):
+    items = encode_rows(device_rows(rows), hexen=hexen)
+    data = benchmark(dehexify, items)
+    assert data.count('\n') == rows
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_format_params(benchmark, rows):
+    # Requests are small except for the ones carrying a client search
+    # or a file chunk, so scale one value with the row count.
+    items = encode_rows(device_rows(rows))
+    params = benchmark(ESM._format_params, 'MISC_READFILE',
+                       FNAME='tok1', SPOS='0', NBYTES='0', DATA=items,
+                       SEARCH=None)
+    assert params.startswith('Request=API%13MISC_READFILE%13%14')
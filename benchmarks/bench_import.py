@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+CLI startup benchmarks. Run with: make bench
+
+Each sample starts a fresh interpreter with python -X importtime, so
+the numbers include what a wrapper script pays per call.
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+# Modules that only the code paths needing them may import.
+HEAVY = ['requests', 'urllib3', 'dateutil', 'prettytable']
+
+# Cumulative import time budget for esmcheckds2.console in microseconds.
+BUDGET_US = 60000
+
+
+def importtime(statement):
+    """
+    Run statement in a new interpreter.
+
+    Returns:
+        dict of module name to cumulative import time in microseconds
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           statement], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            pass
+    return times
+
+
+def test_console_import(benchmark):
+    times = benchmark.pedantic(importtime, ('import esmcheckds2.console',),
+                               rounds=5)
+    loaded = [name for name in HEAVY if name in times]
+    assert not loaded, 'imported at startup: {}'.format(', '.join(loaded))
+    assert times['esmcheckds2.console'] < BUDGET_US
+
+
+@pytest.mark.parametrize('argv', [['--version'], ['--help']])
+def test_cli_exit(benchmark, argv):
+    statement = ('import sys; sys.argv = {!r}\n'
+                 'from esmcheckds2.console import main\n'
+                 'try:\n'
+                 '    main()\n'
+                 'except SystemExit:\n'
+                 '    pass'.format(['esmcheckds2'] + argv))
+    times = benchmark.pedantic(importtime, (statement,), rounds=5)
+    loaded = [name for name in HEAVY if name in times]
+    assert not loaded, 'imported for {}: {}'.format(argv[0],
+                                                    ', '.join(loaded))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Memory retained by parsed client rows with and without the DevTree
+string pool. The byte counts land in the benchmark's extra_info and
+are printed with -s.
+"""
+
+import tracemalloc
+import pytest
+from esmcheckds2.esmcheckds2 import DevTree
+from benchmarks.payloads import clients_payload
+
+
+class _NoPool(object):
+    """
+    Stand-in for the DevTree string pool that keeps every copy.
+    """
+
+    @staticmethod
+    def setdefault(key, default):
+        return default
+
+
+def _retained(strings, payload):
+    tree = DevTree.__new__(DevTree)
+    tree._strings = strings
+    tracemalloc.start()
+    rows = tree._format_clients(payload)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    return retained
+
+
+@pytest.mark.parametrize('rows', [10000, 200000])
+def test_client_row_memory(benchmark, rows):
+    payload = clients_payload(rows)
+    pooled = benchmark.pedantic(_retained, args=({}, payload), rounds=1)
+    plain = _retained(_NoPool(), payload)
+    benchmark.extra_info['pooled_bytes'] = pooled
+    benchmark.extra_info['plain_bytes'] = plain
+    print('\n{} rows: {:.1f} MB pooled, {:.1f} MB without pool ({:.0%} saved)'
+          .format(rows, pooled / 2**20, plain / 2**20, 1 - pooled / plain))
+    assert pooled < plain
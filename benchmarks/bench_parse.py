@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Device tree parsing and filtering benchmarks. Run with: make bench
+
+Each stage gets the already decoded input it sees in a real build, so
+a regression shows up in the stage that caused it.
+"""
+
+from datetime import datetime
+import pytest
+from esmcheckds2.console import filter_by_time
+from esmcheckds2.esmcheckds2 import DevTree, dehexify
+from benchmarks.payloads import (SIZES, clients_payload, datasources,
+                                 encode_rows, time_rows, tree_rows)
+
+
+def _tree():
+    """
+    DevTree with only the state the parsing stages use.
+    """
+    tree = DevTree.__new__(DevTree)
+    tree._strings = {}
+    return tree
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_format_devtree(benchmark, rows):
+    resp = {'ITEMS': dehexify(encode_rows(tree_rows(rows)))}
+    tree = _tree()
+    parsed = benchmark(lambda: list(tree._format_devtree(resp)))
+    assert len(parsed) == rows
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_insert_rec_info(benchmark, rows):
+    resp = {'ITEMS': dehexify(encode_rows(tree_rows(rows)))}
+    tree = _tree()
+    parsed = list(tree._format_devtree(resp))
+    result = benchmark(lambda: list(tree._insert_rec_info(parsed)))
+    assert all(ds['parent_id'] for ds in result if ds['desc_id'] == '3')
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_format_clients(benchmark, rows):
+    payload = clients_payload(rows)
+    clients = benchmark(_tree()._format_clients, payload)
+    assert len(clients) == rows
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_format_times(benchmark, rows):
+    resp = {'ITEMS': dehexify(encode_rows(time_rows(rows)))}
+    times = benchmark(_tree()._format_times, resp)
+    assert len(times) == rows
+
+
+@pytest.mark.parametrize('rows', SIZES)
+def test_filter_by_time(benchmark, rows):
+    rows = datasources(rows)
+    matched = benchmark(filter_by_time, rows, datetime(2017, 10, 15))
+    assert matched
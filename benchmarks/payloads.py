@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic ESM payloads for the benchmarks.
+
+Rows are percent-encoded the way the ESM sends them: fields joined with
+%11, rows ended with %12, and key/value pairs framed with %13/%14 inside
+a Response= body. Some ESM versions send the raw \x1c/\x12 control
+characters as separators instead; encode_rows(hexen=True) does that.
+"""
+
+import random
+import urllib.parse as urlparse
+
+# Row counts the parser benchmarks run at.
+SIZES = [1000, 10000, 100000, 500000]
+
+TIMES = ['2017/08/16 08:13:03', '08/16/2017 15:10:45',
+         '2017/10/16 19:50:00', '10/14/2017 01:00:00', '']
+
+
+def encode_rows(rows, hexen=False):
+    """
+    Args:
+        rows (list): list of lists of field strings
+        hexen (bool): separate with \x1c and \x12 instead of %11 and %12
+
+    Returns:
+        str. Encoded ITEMS value
+    """
+    sep, eol = ('\x1c', '\x12') if hexen else ('%11', '%12')
+    return ''.join(sep.join(urlparse.quote(field, safe='')
+                            for field in row) + eol
+                   for row in rows)
+
+
+def ess_response(**pairs):
+    """
+    Returns:
+        str. ESS response body carrying the given key/value pairs
+    """
+    return 'Response=' + ''.join('{}%13{}%13%14'.format(key, val)
+                                 for key, val in pairs.items())
+
+
+def _device_row(rng, desc_id, name, idx, client_groups='0'):
+    row = [desc_id, name, str(100000 + idx)]
+    row.extend(['x'] * 12)
+    row.append(rng.choice('TTTF'))
+    row.append(str(rng.choice([43, 65, 77, 199, 354])))
+    row.extend(['y'] * 10)
+    row.append('10.{}.{}.{}'.format(idx // 65536 % 256,
+                                    idx // 256 % 256, idx % 256))
+    row.append('host-{}.example.com'.format(idx))
+    row.append(client_groups)
+    return row
+
+
+def device_rows(count, seed=0):
+    """
+    Device tree rows with the 30 fields _format_devtree expects.
+    """
+    rng = random.Random(seed)
+    return [_device_row(rng, '3', 'Datasource {} (prod)'.format(idx), idx)
+            for idx in range(count)]
+
+
+def tree_rows(count, seed=0, per_receiver=2000):
+    """
+    A device tree in ESM order: the ESM, then every receiver followed by
+    its devices. Most devices are datasources; some are client
+    containers, which carry two extra leading fields, and some are
+    McAfee devices or SIEM appliances.
+
+    Returns:
+        list of count rows
+    """
+    rng = random.Random(seed)
+    rows = [_device_row(rng, '14', 'ESM', 0)]
+    for idx in range(1, count):
+        if idx % per_receiver == 1:
+            rows.append(_device_row(rng, '2', 'Receiver {}'.format(idx), idx))
+        elif idx % 50 == 0:
+            rows.append(['0', '0'] + _device_row(
+                rng, '3', 'Container {}'.format(idx), idx, '25'))
+        elif idx % 97 == 0:
+            rows.append(_device_row(rng, rng.choice(['19', '21', '4', '10']),
+                                    'Device {}'.format(idx), idx))
+        else:
+            rows.append(_device_row(rng, '3', 'Datasource {}'.format(idx),
+                                    idx))
+    return rows
+
+
+def devtree_response(count, seed=0):
+    """
+    GRP_GETVIRTUALGROUPIPSLISTDATA response body for count datasources.
+    """
+    return ess_response(ITEMS=encode_rows(device_rows(count, seed)))
+
+
+VENDORS = [('Microsoft', 'Windows Event Log - WMI'),
+           ('Microsoft', 'Windows Event Log - MEF'),
+           ('Linux', 'Linux (syslog)'),
+           ('Cisco', 'IOS'),
+           ('Cisco', 'ASA'),
+           ('VMware', 'VMware'),
+           ('McAfee', 'Web Gateway')]
+
+
+def client_rows(count, seed=0):
+    """
+    Client datasource rows with the 13 fields _format_clients expects.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for idx in range(count):
+        vendor, model = rng.choice(VENDORS)
+        rows.append([str(200000 + idx),
+                     'client-{}'.format(idx),
+                     rng.choice('TTTF'),
+                     '10.{}.{}.{}'.format(idx // 65536 % 256,
+                                          idx // 256 % 256, idx % 256),
+                     'client-{}.example.com'.format(idx),
+                     str(rng.choice([43, 65, 77, 199, 354])),
+                     vendor,
+                     model,
+                     str(rng.choice([1, 2, 5, 13, 27])),
+                     rng.choice(['0', '1']),
+                     '',
+                     rng.choice(['514', '6514']),
+                     rng.choice('FT')])
+    return rows
+
+
+def clients_payload(count, seed=0):
+    """
+    Decoded client list, as returned by DevTree._get_clients.
+    """
+    return ''.join(','.join(row) + '\n' for row in client_rows(count, seed))
+
+
+def time_rows(count, seed=0):
+    """
+    QRY_GETDEVICELASTALERTTIME rows: name, id, model, last time, flags.
+    """
+    rng = random.Random(seed)
+    return [['Datasource {}'.format(idx), str(100000 + idx),
+             rng.choice(VENDORS)[1], rng.choice(TIMES), '0']
+            for idx in range(count)]
+
+
+def datasources(count, seed=0):
+    """
+    Datasource dicts as the console filters see them.
+    """
+    rng = random.Random(seed)
+    return [{'name': 'Datasource {}'.format(idx),
+             'ds_id': str(100000 + idx),
+             'ds_ip': '10.{}.{}.{}'.format(idx // 65536 % 256,
+                                           idx // 256 % 256, idx % 256),
+             'model': rng.choice(VENDORS)[1],
+             'parent_name': 'Receiver {}'.format(idx // 2000),
+             'zone_name': rng.choice(['DMZ', 'Core', '']),
+             'last_time': rng.choice(TIMES + ['never'])}
+            for idx in range(count)]
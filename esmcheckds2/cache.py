@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+def cache_dir():
+    """
+    Locate and create the per-user esmcheckds2 cache directory.
+
+    Returns:
+        str. Path of a directory only readable by the current user.
+    """
+    if 'LOCALAPPDATA' in os.environ:
+        base = os.environ['LOCALAPPDATA']
+    elif 'XDG_CACHE_HOME' in os.environ:
+        base = os.environ['XDG_CACHE_HOME']
+    elif 'HOME' in os.environ:
+        base = os.path.join(os.environ['HOME'], '.cache')
+    else:
+        base = tempfile.gettempdir()
+
+    path = os.path.join(base, 'esmcheckds2')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def cache_key(*parts):
+    """
+    Stable file name friendly key for a host/user combination.
+    """
+    digest = hashlib.sha256('\0'.join(parts).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def atomic_write(filename, data, mode=0o644):
+    """
+    Replace filename with data without readers ever seeing a partial
+    file.
+
+    Args:
+        filename (str): destination file
+        data (str or bytes): new contents
+        mode (int): permissions of the new file
+
+    Raises:
+        OSError if the file cannot be written
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as open_f:
+            open_f.write(data)
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, filename)
+    except OSError:
+        os.unlink(tmpname)
+        raise
+
+
+def read_json(filename):
+    """
+    Returns:
+        Decoded JSON from filename or None if missing or unreadable.
+    """
+    try:
+        with open(filename) as open_f:
+            return json.load(open_f)
+    except (OSError, ValueError):
+        return None
+
+
+class FileLock(object):
+    """
+    Exclusive lock on a file shared between processes. acquire() blocks
+    until no other process holds it; the OS drops the lock if the
+    holder dies.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.filename, 'a+')
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            return
+        self._file.seek(0)
+        while True:
+            # LK_LOCK gives up after 10 seconds; keep waiting.
+            try:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def release(self):
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def write_json(filename, obj, mode=0o600):
+    """
+    Atomically write obj as JSON. Private (0600) by default since cache
+    files can hold session tokens.
+    """
+    atomic_write(filename, json.dumps(obj), mode)
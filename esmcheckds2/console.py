@@ -6,13 +6,11 @@ import logging
 import os
 import socket
 import sys
-import dateutil.parser as dateparser
-from configparser import ConfigParser, NoSectionError, MissingSectionHeaderError
 from datetime import datetime, timedelta
-from io import StringIO
-from esmcheckds2.esmcheckds2 import Config, ESM, dehexify, DevTree
 from esmcheckds2.version import __version__
-from prettytable import PrettyTable, PLAIN_COLUMNS, MSWORD_FRIENDLY
+
+# requests, dateutil and prettytable are imported where they are used so
+# --help, --version and argument errors return without loading them.
 
 def logging_init():
     logfile = "esmcheckds2.log"
@@ -28,19 +26,6 @@ def logging_init():
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-def _get_time_obj(time_str):
-    """
-    Converts given timestamp string to datetime object
-    
-    Args:
-        time_str (str): time as a string, e.g. 2019/02/28 22:22:22
-                         
-    Returns:
-        datetime object or None if no format matches 
-        
-    """
-    return dateparser.parse(time_str)
-
 def lol_to_table(lol, format=None, headers=None):
     """
     Args:
@@ -52,6 +37,7 @@ def lol_to_table(lol, format=None, headers=None):
         obj - prettytable object
         
     """
+    from prettytable import PrettyTable, PLAIN_COLUMNS, MSWORD_FRIENDLY
     table = PrettyTable(field_names=headers)
     for ds_row in lol:
         table.add_row([f for f in ds_row])
@@ -101,8 +87,427 @@ def print_csv(lol, headers=None):
     for row in lol:
         print(','.join(row))
             
-def main():
+INTERNAL_TYPES = {'1': 'zone',
+                  '2': 'ERC',
+                  '3': 'datasource',
+                  '4': 'Database Event Monitor (DBM)',
+                  '5': 'DBM Database',
+                  '7': 'Policy Auditor',
+                  '10': 'Application Data Monitor (ADM)',
+                  '12': 'ELM',
+                  '13': 'Local Receiver-ELM',
+                  '14': 'Local ESM',
+                  '15': 'Advanced Correlation Engine (ACE)',
+                  '16': 'Asset datasource',
+                  '17': 'Score-based Correlation',
+                  '19': 'McAfee ePolicy Orchestrator (ePO)',
+                  '20': 'EPO Module',
+                  '21': 'McAfee Network Security Manager (NSM)',
+                  '22': 'McAfee Network Security Platform (NSP)',
+                  '23': 'NSP Port',
+                  '24': 'McAfee Vulnerability Manager (MVM)',
+                  '25': 'Enterprise Log Search (ELS)',
+                  '254': 'client_group',
+                  '256': 'client'}
+TYPE_FILTER = ['1', '16', '254']
+MFE_TYPES = ['7', '19', '20', '21', '22', '23', '24']
+SIEM_TYPES = ['2', '4', '5', '10', '12', '13', '14', '15', '17', '25']
+
+def datasource_criteria(devtree, zone=None, exclude_disabled=False,
+                        exclude_mfe=False, exclude_siem=False):
+    """
+    Translate the command line filters into DevTree.select() criteria.
+
+    Args:
+        devtree (DevTree)
+        zone (str): zone name, case insensitive
+        exclude_disabled (bool)
+        exclude_mfe (bool): exclude top level McAfee devices
+        exclude_siem (bool): exclude SIEM devices
+
+    Returns:
+        dict of select() criteria
+    """
+    type_filter = list(TYPE_FILTER)
+    if exclude_mfe:
+        type_filter.extend(MFE_TYPES)
+    if exclude_siem:
+        type_filter.extend(SIEM_TYPES)
+
+    criteria = {'desc_id': [int_t_id for int_t_id in INTERNAL_TYPES.keys()
+                            if int_t_id not in type_filter]}
+    if exclude_disabled:
+        criteria['enabled'] = [state for state in devtree.values('enabled')
+                               if state != 'F']
+    if zone:
+        criteria['zone_name'] = [name for name in devtree.values('zone_name')
+                                 if (name or '').lower() == zone.lower()]
+    return criteria
+
+def parse_buckets(buckets):
+    """
+    argparse type for --buckets
+
+    Args:
+        buckets (str): comma separated ages, e.g. 15m,1h,1d,7d
+
+    Returns:
+        list of (label, timedelta) tuples, shortest first
+    """
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours',
+             'd': 'days', 'w': 'weeks'}
+    parsed = []
+    for label in buckets.split(','):
+        label = label.strip()
+        try:
+            delta = timedelta(**{units[label[-1]]: int(label[:-1])})
+        except (KeyError, ValueError, IndexError):
+            raise argparse.ArgumentTypeError(
+                'invalid bucket: {!r} (use e.g. 15m,1h,1d,7d)'.format(label))
+        parsed.append((label, delta))
+    return sorted(parsed, key=lambda bucket: bucket[1])
+
+def bucket_report(devtree, now, buckets, criteria):
+    """
+    Idle counts for every zone and parent device from the sorted last
+    time index.
+
+    Args:
+        devtree (DevTree)
+        now (datetime): ESM time
+        buckets (list): output of parse_buckets()
+        criteria (dict): output of datasource_criteria()
+
+    Returns:
+        tuple - (headers, list of lists)
+    """
+    thresholds = [delta for _, delta in buckets]
+    headers = (['Group', 'Name', 'Total']
+               + ['>' + label for label, _ in buckets] + ['Never'])
+    rows = []
+    for group, field in (('zone', 'zone_name'), ('parent', 'parent_name')):
+        counts = devtree.idle_counts(now, thresholds, field, **criteria)
+        for name, row in counts.items():
+            rows.append([group, name or ''] + [str(count) for count in row])
+    return headers, rows
+
+OUTPUT_FORMATS = ['text', 'csv', 'word', 'prom', 'tree', 'tree-json']
+
+def parse_output(output):
+    """
+    argparse type for --output
+
+    Args:
+        output (str): FORMAT:PATH, or FORMAT alone or FORMAT:- for stdout
+
+    Returns:
+        tuple - (format, path or None)
+    """
+    out_format, _, path = output.partition(':')
+    if out_format not in OUTPUT_FORMATS:
+        raise argparse.ArgumentTypeError(
+            'invalid output format: {!r} (choose from {})'
+            .format(out_format, ', '.join(OUTPUT_FORMATS)))
+    if path == '-':
+        path = ''
+    return out_format, path or None
+
+def emit_output(out_format, filename, result):
+    """
+    Write one output of a run. Called once per --output, concurrently
+    for outputs going to files; the result is only read.
+
+    Args:
+        out_format (str): one of OUTPUT_FORMATS or None for a table
+        filename (str): destination, None or False for stdout
+        result (dict): devtree, selected, headers, rows, now,
+                       time_filter, idle_before, zone, host, profiler
+    """
+    headers = result['headers']
+    output_lol = result['rows']
+    if out_format == 'prom':
+        from esmcheckds2.prom import format_prom, write_prom
+        write_prom(filename, format_prom(result['selected'], result['now'],
+                                         result['idle_before'],
+                                         host=result['host'],
+                                         profiler=result['profiler']))
+
+    elif out_format in ('tree', 'tree-json'):
+        from esmcheckds2.tree import build_tree, format_tree
+        roots = build_tree(result['devtree'], result['selected'],
+                           result['idle_before'])
+        if out_format == 'tree':
+            out_tree = format_tree(roots)
+        else:
+            import json
+            out_tree = json.dumps(roots, indent=2)
+        if filename:
+            write_table(filename, out_tree)
+        else:
+            print(out_tree)
+
+    elif out_format == 'csv':
+        if filename:
+            write_csv(filename, output_lol, headers)
+        else:
+            print_csv(output_lol, headers)
+
+    else:
+        out_table = lol_to_table(output_lol, out_format, headers)
+        count = len(output_lol)
+        if filename:
+            write_table(filename, out_table)
+        else:
+            try:
+                print(out_table)
+                print('ESM: {} | ESM Time UTC: {} | Time Offset: {} | Zone: {} | Device Count: {}'
+                       .format(result['host'], result['now'],
+                               result['time_filter'], result['zone'], count))
+            except UnicodeEncodeError:
+                print('Console does not support Unicode characters')
+
+def time_window(now, days=None, hours=None, minutes=None,
+                future_only=False):
+    """
+    Cutoff for filter_by_time() from the command line timeframe.
+
+    Args:
+        now (datetime): ESM time
+        days, hours, minutes (int): idle for longer than this. The
+                                    smallest unit given wins.
+        future_only (bool): cutoff for devices with a time in the future
+
+    Returns:
+        datetime, or False to keep every device
+    """
+    if future_only:
+        return now + timedelta(minutes=1)
+    td = None
+    if days is not None:
+        td = timedelta(days=days)
+    if hours is not None:
+        td = timedelta(hours=hours)
+    if minutes is not None:
+        td = timedelta(minutes=minutes)
+    if td is None:
+        return False
+    return now - td
+
+def filter_by_time(datasources, time_filter=False, future_only=False):
+    """
+    Args:
+        datasources (list): datasource dicts
+        time_filter (datetime): idle cutoff, or the future cutoff with
+                                future_only. False to keep every device.
+        future_only (bool): only devices with a last time in the future
+
+    Returns:
+        list of datasource dicts
+    """
+    from esmcheckds2.esmcheckds2 import no_last_time, parse_time
+    matched = []
+    for ds in datasources:
+        if not ds.get('last_time'):
+            ds['last_time'] = 'n/a'
+
+        if no_last_time(ds['last_time']):
+            if future_only:
+                logging.debug('PASS - time not future: {}'.format(ds['name']))
+            else:
+                logging.debug('ADD - no last time: {}'.format(ds['name']))
+                matched.append(ds)
+            continue
+
+        if not time_filter:
+            logging.debug('ADD - all devices times: {}'.format(ds['name']))
+            matched.append(ds)
+            continue
+
+        last_time = parse_time(ds['last_time'])
+        if not last_time:
+            logging.debug('PASS - invalid time: {}'.format(ds['name']))
+            continue
+
+        if future_only:
+            if last_time > time_filter:
+                matched.append(ds)
+                logging.debug('ADD - future-time: {}'.format(ds['name']))
+            else:
+                logging.debug('PASS - time not future: {}'.format(ds['name']))
+        elif last_time < time_filter:
+            matched.append(ds)
+            logging.debug('ADD - idle too long: {}'.format(ds['name']))
+        else:
+            logging.debug('PASS - not idle: {} - {}'.format(ds['name'], ds['last_time']))
+    return matched
+
+def fetch_devtree(config, pargs, profiler):
+    """
+    Log into the ESM and build the device tree.
+
+    Args:
+        config (Config)
+        pargs (Namespace): parsed command line
+        profiler (Profiler): collects the run stats
+
+    Returns:
+        DevTree
+    """
+    from esmcheckds2.esmcheckds2 import ESM, DevTree
+    from esmcheckds2.limiter import AIMDLimiter
+    esm = ESM(config, profiler=profiler, retries=pargs.retries,
+              limiter=AIMDLimiter(maximum=pargs.workers),
+              session_cache=pargs.reuse_session,
+              connect_timeout=pargs.connect_timeout,
+              read_timeout=pargs.timeout)
+    tree_opts = {'parse_workers': pargs.parse_workers}
+    if pargs.client_cache is not None:
+        tree_opts['client_cache'] = True
+        tree_opts['client_max_age'] = pargs.client_cache * 3600
+    devtree = DevTree(esm, **tree_opts)
+    if not pargs.reuse_session:
+        esm.logout()
+    return devtree
+
+def serve_main(argv):
+    """
+    esmcheckds2 serve: keep the device tree in memory and answer
+    queries over HTTP.
+
+    Args:
+        argv (list): arguments after 'serve'
+    """
+    parser = argparse.ArgumentParser(
+        prog='esmcheckds2 serve',
+        description='Serve ESM datasource queries as JSON over HTTP. '
+                    'GET /datasources takes the CLI filters as query '
+                    'parameters: zone, disabled, mfe, siem, days, hours, '
+                    'minutes, future and dsid. GET /status shows when '
+                    'the data was last refreshed.')
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on (default: 8080)')
+    parser.add_argument('--topology-interval', type=int, default=3600,
+                        metavar='SECS',
+                        help='Seconds between full device tree refreshes '
+                             '(default: 3600)')
+    parser.add_argument('--times-interval', type=int, default=300,
+                        metavar='SECS',
+                        help='Seconds between last time refreshes '
+                             '(default: 300)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Retries for failed ESM reads (default: 3)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        metavar='SECS',
+                        help='Seconds to wait for ESM data (default: 300)')
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        metavar='SECS',
+                        help='Seconds to wait for an ESM connection '
+                             '(default: 10)')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Max parallel ESM requests (default: 16)')
+    parser.add_argument('--client-cache', nargs='?', type=float, const=24,
+                        default=None, metavar='HRS',
+                        help='Reuse unchanged client lists for up to HRS '
+                             '(default: 24)')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Processes for parsing large client lists '
+                             '(default: 0)')
+    parser.add_argument('--debug', action='store_true',
+                        help='Enable debug output')
+    pargs = parser.parse_args(argv)
+
+    if pargs.debug:
+        logging_init()
+
+    from esmcheckds2.esmcheckds2 import Config, ESM
+    from esmcheckds2.limiter import AIMDLimiter
+    from esmcheckds2.server import TreeServer
     config = Config()
+    esm = ESM(config, retries=pargs.retries,
+              limiter=AIMDLimiter(maximum=pargs.workers), relogin=True,
+              connect_timeout=pargs.connect_timeout,
+              read_timeout=pargs.timeout)
+    tree_opts = {'parse_workers': pargs.parse_workers}
+    if pargs.client_cache is not None:
+        tree_opts['client_cache'] = True
+        tree_opts['client_max_age'] = pargs.client_cache * 3600
+    server = TreeServer(esm, tree_opts,
+                        topology_interval=pargs.topology_interval,
+                        times_interval=pargs.times_interval)
+    print('Loading device tree from {}...'.format(esm.host))
+    server.start()
+    print('Serving on http://{}:{}/'.format(pargs.bind, pargs.port))
+    try:
+        server.serve_forever(pargs.bind, pargs.port)
+    finally:
+        server.stop()
+        esm.logout()
+
+def diff_main(argv):
+    """
+    esmcheckds2 diff: compare two snapshots saved with --snapshot.
+
+    Args:
+        argv (list): arguments after 'diff'
+    """
+    parser = argparse.ArgumentParser(
+        prog='esmcheckds2 diff',
+        description='Show datasources added, removed, enabled or '
+                    'disabled, moved to another IP, zone or parent, and '
+                    'last times that went backwards between two '
+                    'snapshots saved with --snapshot.')
+    parser.add_argument('old', metavar='SNAP_A', help='Earlier snapshot')
+    parser.add_argument('new', metavar='SNAP_B', help='Later snapshot')
+    parser.add_argument('-f', '--format', default=None, dest='out_format',
+                        choices=['text', 'csv', 'word'],
+                        help='Result format')
+    parser.add_argument('-w', '--write', nargs='?', const='ds_diff.txt',
+                        default=False,
+                        help='Output to file (default: ds_diff.txt)')
+    pargs = parser.parse_args(argv)
+
+    from esmcheckds2.diff import diff_trees
+    from esmcheckds2.snapshot import load_snapshot
+    snapshots = []
+    for filename in (pargs.old, pargs.new):
+        try:
+            snapshots.append(load_snapshot(filename))
+        except (OSError, ValueError):
+            print('Could not read snapshot: {}'.format(filename))
+            sys.exit(1)
+
+    headers = ['Change', 'DS ID', 'Name', 'Old', 'New']
+    output_lol = [[change['change'], change['ds_id'], change['name'] or '',
+                   change['old'] or '', change['new'] or '']
+                  for change in diff_trees(*snapshots)]
+    filename = pargs.write
+    if pargs.out_format == 'csv':
+        if filename:
+            write_csv(filename, output_lol, headers)
+        else:
+            print_csv(output_lol, headers)
+    else:
+        out_table = lol_to_table(output_lol, pargs.out_format, headers)
+        if filename:
+            write_table(filename, out_table)
+        else:
+            print(out_table)
+            print('A: {} | B: {} | Changes: {}'
+                  .format(snapshots[0].esm_time, snapshots[1].esm_time,
+                          len(output_lol)))
+
+def main():
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+    if sys.argv[1:2] == ['serve']:
+        serve_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['diff']:
+        diff_main(sys.argv[2:])
+        return
     # try:
     #     host = config.esmhost
     # except AttributeError:
@@ -119,12 +524,15 @@ def main():
     #     print("Cannot find 'esmpass' key in .mfe_saw.ini")
     #     sys.exit(0)
     helpdoc = '''\
-    usage: esmcheckds2 <-d|-h|-m|-a|--future> <timeframe> [OPTIONS]
+    usage: esmcheckds2 <-d|-h|-m|-a|--future|--buckets> <timeframe> [OPTIONS]
+           esmcheckds2 serve [--port PORT] [OPTIONS]
+           esmcheckds2 diff SNAP_A SNAP_B [-f FORMAT]
 
     Show McAfee ESM Datasource Activity
     Specify days, hours, minutes 
     Example: esmcheckds2 -d 1
              esmcheckds2 -a --disabled
+             esmcheckds2 serve --help
              
     Timeframe Options:
       -d, --days <num>     Days since datasource active
@@ -132,6 +540,7 @@ def main():
       -m, --minutes <num>  Minutes since datasource active
       -a, --all            Show all devices
       --future             Only devices with time in future 
+      --buckets <ages>     Idle counts per zone and parent, e.g. 15m,1h,1d,7d
       
     Additional Options:
       -z, --zone [zone]    Limit devices to zone
@@ -139,9 +548,20 @@ def main():
       --mfe                Exclude top level McAfee devices (EPO, NSM...)
       --siem               Exclude SIEM devices (ESM, ERC...)
       --dsid               Display the Datasource ID field
-      -f, --format         Result format: csv, text, MS word 
+      -f, --format         Result format: csv, text, MS word, prom, tree, tree-json
       -w, --write [file]   Output to file (default: ds_results.txt)
+      -o, --output <fmt:file> Also write format to file; repeatable, e.g. csv:ds.csv
       -v, --version        Print version
+      --retries <num>      Retries for failed ESM reads (default: 3)
+      --timeout <secs>     Seconds to wait for ESM data (default: 300)
+      --connect-timeout <secs> Seconds to wait for an ESM connection (default: 10)
+      --workers <num>      Max parallel ESM requests (default: 16)
+      --reuse-session      Keep the ESM session between runs
+      --client-cache [hrs] Reuse unchanged client lists for up to hrs (default: 24)
+      --parse-workers <num> Processes for parsing large client lists (default: 0)
+      --snapshot <file>    Save the device tree for esmcheckds2 diff
+      --single-flight [s]  Share one ESM fetch with runs in the last s seconds (default: 60)
+      --profile [file]     Write timing and HTTP stats as JSON (default: stderr)
       --debug              Enable debug output
       --help               Show this help message and exit'''
     
@@ -149,7 +569,7 @@ def main():
         print(helpdoc)
         sys.exit(0)
         
-    output_formats = ['text', 'csv', 'word']
+    output_formats = OUTPUT_FORMATS
     parser = argparse.ArgumentParser(prog='esmcheckds2',
                                      add_help=False,
                                      usage=argparse.SUPPRESS,                                 
@@ -165,6 +585,7 @@ def main():
     p_group.add_argument('-a', '--all', dest='show_all', action='store_true', 
                             help=argparse.SUPPRESS)
     p_group.add_argument('--future', action='store_true', help=argparse.SUPPRESS)
+    p_group.add_argument('--buckets', type=parse_buckets, help=argparse.SUPPRESS)
     p_group.add_argument('--help', action='help', help=argparse.SUPPRESS)
     parser.add_argument("-z", '--zone', nargs='?', const=None, 
                             default=False, help=argparse.SUPPRESS)
@@ -178,11 +599,34 @@ def main():
                             choices=output_formats, help=argparse.SUPPRESS)
     parser.add_argument("-w", '--write', nargs='?', const='ds_results.txt', 
                             default=False, help=argparse.SUPPRESS)
+    parser.add_argument('-o', '--output', action='append', default=[],
+                            dest='outputs', type=parse_output,
+                            help=argparse.SUPPRESS)
     parser.add_argument('-v', '--version', action='version', help=argparse.SUPPRESS,
                             version='%(prog)s {version}'.format(version=__version__))    
+    parser.add_argument('--retries', type=int, default=3, help=argparse.SUPPRESS)
+    parser.add_argument('--timeout', type=float, default=300, help=argparse.SUPPRESS)
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                            help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, default=16, help=argparse.SUPPRESS)
+    parser.add_argument('--reuse-session', action='store_true',
+                            help=argparse.SUPPRESS)
+    parser.add_argument('--client-cache', nargs='?', type=float, const=24,
+                            default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--parse-workers', type=int, default=0,
+                            help=argparse.SUPPRESS)
+    parser.add_argument('--snapshot', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--single-flight', nargs='?', type=float, const=60,
+                            default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--profile', nargs='?', const='-',
+                            default=None, help=argparse.SUPPRESS)
     parser.add_argument('--debug', action='store_true', help=argparse.SUPPRESS)
     pargs = parser.parse_args()
 
+    from esmcheckds2.esmcheckds2 import Config
+    from esmcheckds2.profiler import Profiler
+    config = Config()
+
     if pargs.debug:
         logging_init()
         
@@ -196,143 +640,93 @@ def main():
     future_only = pargs.future
     show_all = pargs.show_all
     
-    esm = ESM(config)
-    now_str = esm.time()[:-7]
-    _devtree = DevTree(esm)
-    esm.logout()
-
     host = config.esmhost
+    profiler = Profiler()
+    if pargs.single_flight is not None:
+        from esmcheckds2.cache import cache_dir, cache_key
+        from esmcheckds2.snapshot import shared_snapshot
+        # Keyed on the user as well: accounts see different devices.
+        shared = os.path.join(cache_dir(), 'tree-{}.snap'.format(
+            cache_key(host, config.esmuser)))
+        _devtree = shared_snapshot(
+            shared, pargs.single_flight,
+            lambda: fetch_devtree(config, pargs, profiler))
+    else:
+        _devtree = fetch_devtree(config, pargs, profiler)
+    if pargs.snapshot:
+        from esmcheckds2.snapshot import save_snapshot
+        try:
+            save_snapshot(_devtree, pargs.snapshot)
+        except OSError:
+            print('Could not write to file: {}'.format(pargs.snapshot))
+    now_str = _devtree.esm_time[:-7]
 
     now = datetime.strptime(now_str, '%Y-%m-%dT%H:%M:%S')
-    if show_all:
+    if show_all or pargs.buckets:
         time_filter = False
-    elif future_only:
-        td = timedelta(minutes=1)
-        time_filter = now + td
     else:
-        if pargs.days is not None:
-            td = timedelta(days=pargs.days)
-        if pargs.hours is not None:
-            td = timedelta(hours=pargs.hours)
-        if pargs.minutes is not None:
-            td = timedelta(minutes=pargs.minutes)        
-        time_filter = now - td
+        time_filter = time_window(now, pargs.days, pargs.hours,
+                                  pargs.minutes, future_only)
 
     
-    internal_types = {'1': 'zone',
-                       '2': 'ERC',
-                       '3': 'datasource',
-                       '4': 'Database Event Monitor (DBM)',
-                       '5': 'DBM Database',
-                       '7': 'Policy Auditor',
-                       '10': 'Application Data Monitor (ADM)',
-                       '12': 'ELM',
-                       '13': 'Local Receiver-ELM',
-                       '14': 'Local ESM',
-                       '15': 'Advanced Correlation Engine (ACE)',
-                       '16': 'Asset datasource',
-                       '17': 'Score-based Correlation',
-                       '19': 'McAfee ePolicy Orchestrator (ePO)',
-                       '20': 'EPO Module',
-                       '21': 'McAfee Network Security Manager (NSM)',
-                       '22': 'McAfee Network Security Platform (NSP)',
-                       '23': 'NSP Port',
-                       '24': 'McAfee Vulnerability Manager (MVM)',
-                       '25': 'Enterprise Log Search (ELS)',
-                       '254': 'client_group',
-                       '256': 'client'}
-    type_filter = ['1', '16', '254']
-    mfe_types = ['7', '19', '20', '21', '22', '23', '24']
-    siem_types = ['2', '4', '5', '10', '12', '13', '14', '15', '17', '25']
-    
-    if exclude_mfe:
-        type_filter.extend(mfe_types)
-
-    if exclude_siem:
-        type_filter.extend(siem_types)
-        
-    ds_types = [int_t_id for int_t_id in internal_types.keys() 
-                    if int_t_id not in type_filter]
+    with profiler.stage('filter'):
+        criteria = datasource_criteria(_devtree, zone=zone,
+                                       exclude_disabled=exclude_disabled,
+                                       exclude_mfe=exclude_mfe,
+                                       exclude_siem=exclude_siem)
+        selected = _devtree.select(**criteria)
+        logging.debug('KEEP - after type, state and zone filters: {} devices'
+                      .format(len(selected)))
+        if pargs.buckets:
+            headers, output_lol = bucket_report(_devtree, now, pargs.buckets,
+                                                criteria)
+        else:
+            matched = filter_by_time(selected, time_filter, future_only)
 
-    output_lol = []
-    for ds in _devtree:
-        if ds['desc_id'] not in ds_types:
-            logging.debug('PASS - filtered datasource: {}'.format(ds['name']))
-            continue
-        
-        if not ds.get('last_time'):
-            ds['last_time'] = 'n/a'
-        
-        fields = [ds['name'], ds['ds_ip'], ds['model'], 
-                  ds['parent_name'], ds['zone_name'], ds['last_time']]
+    if not pargs.buckets:
         headers = ['Name', 'IP', 'Type', 'Parent Device', 'Zone', 'Last Time']
-        
         if dsid:
-            fields.insert(1, ds['ds_id'])
             headers.insert(1, 'DS ID')
-                
-        if exclude_disabled:
-            if ds['enabled'] == 'F':
-                logging.debug('PASS - disabled datasource: {}'.format(ds['name']))
-                continue
-
-        if zone:
-            if zone.lower() != ds['zone_name'].lower():
-                logging.debug('PASS - out of zone: {}'.format(ds['name']))
-                continue
-            
-        if (ds['last_time'] == 'never') or (ds['last_time'] == 'n/a'):
-            if future_only:
-                logging.debug('PASS - time not future: {}'.format(ds['name']))
-                continue
-            else:
-                logging.debug('ADD - no last time: {}'.format(ds['name']))
-                output_lol.append(fields)
-                continue
-                
-        if show_all:
-            logging.debug('ADD - all devices times: {}'.format(ds['name']))
+        output_lol = []
+        for ds in matched:
+            fields = [ds['name'], ds['ds_ip'], ds['model'],
+                      ds['parent_name'], ds['zone_name'], ds['last_time']]
+            if dsid:
+                fields.insert(1, ds['ds_id'])
             output_lol.append(fields)
-            continue
-
-        last_time = _get_time_obj(ds['last_time'])
-        if not ds['last_time']:
-            logging.debug('PASS - invalid time: {}'.format(ds['name']))
-            continue
 
-        if future_only:
-            if last_time > time_filter:
-                output_lol.append(fields)
-                logging.debug('ADD - future-time: {}'.format(ds['name']))
-                continue
-            else:
-                logging.debug('PASS - time not future: {}'.format(ds['name']))
-                continue
-        elif last_time < time_filter:
-            output_lol.append(fields)
-            logging.debug('ADD - idle too long: {}'.format(ds['name']))
-        else:
-            logging.debug('PASS - not idle: {} - {}'.format(ds['name'], ds['last_time']))
-            continue
-    
-    if out_format == 'csv':
-        if filename:
-            write_csv(filename, output_lol, headers)
-        else:
-            print_csv(output_lol, headers)
-    
+    if not time_filter or future_only:
+        idle_before = None
     else:
-        out_table = lol_to_table(output_lol, out_format, headers)
-        count = len(output_lol)
-        if filename:
-            write_table(filename, out_table)
+        idle_before = time_filter
+
+    result = {'devtree': _devtree, 'selected': selected,
+              'headers': headers, 'rows': output_lol, 'now': now,
+              'time_filter': time_filter, 'idle_before': idle_before,
+              'zone': zone, 'host': host, 'profiler': profiler}
+    outputs = list(pargs.outputs)
+    if not outputs or out_format or filename:
+        outputs.insert(0, (out_format, filename))
+    to_files = [(fmt, path) for fmt, path in outputs if path]
+    to_stdout = [(fmt, path) for fmt, path in outputs if not path]
+
+    with profiler.stage('output'):
+        if len(to_files) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(to_files)) as pool:
+                writes = [pool.submit(emit_output, fmt, path, result)
+                          for fmt, path in to_files]
+                for write in writes:
+                    write.result()
         else:
-            try:
-                print(out_table)
-                print('ESM: {} | ESM Time UTC: {} | Time Offset: {} | Zone: {} | Device Count: {}'
-                       .format(host, now, time_filter, zone, count))
-            except UnicodeEncodeError:
-                print('Console does not support Unicode characters')
+            for fmt, path in to_files:
+                emit_output(fmt, path, result)
+        # Console outputs go one after the other so they do not mix.
+        for fmt, path in to_stdout:
+            emit_output(fmt, path, result)
+
+    if pargs.profile:
+        profiler.write(pargs.profile)
 
 
         
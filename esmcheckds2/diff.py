@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from esmcheckds2.esmcheckds2 import parse_time
+
+# Fields reported as moves: change name -> datasource field.
+MOVES = (('ip', 'ds_ip'),
+         ('zone', 'zone_name'),
+         ('parent', 'parent_name'))
+
+
+# Every field diff_trees() reads.
+FIELDS = ('ds_id', 'name', 'enabled', 'last_time') + tuple(
+    field for _, field in MOVES)
+
+
+def _columns(devtree):
+    """
+    Returns:
+        dict of field -> list of values in tree order, None if missing
+    """
+    # Binary snapshots decode just these columns instead of every row.
+    columns = getattr(devtree, 'columns', None)
+    if columns is not None:
+        return columns(FIELDS)
+    rows = list(devtree)
+    return {field: [ds.get(field) for ds in rows] for field in FIELDS}
+
+
+def _by_id(ds_ids):
+    return {ds_id: pos for pos, ds_id in enumerate(ds_ids) if ds_id}
+
+
+def _time_regressed(old, new):
+    """
+    True if the last event time went backwards or was lost.
+    """
+    if old == new or not old or old in ('never', 'n/a'):
+        return False
+    if not new or new in ('never', 'n/a'):
+        return True
+    old_time = parse_time(old)
+    new_time = parse_time(new)
+    if old_time is None or new_time is None:
+        return False
+    return new_time < old_time
+
+
+def diff_trees(old, new):
+    """
+    Compare two builds of the device tree by ds_id.
+
+    Each tree is indexed by ds_id once and the ids are compared as sets,
+    so the cost is linear in the number of datasources. Only the
+    compared fields are read, column by column.
+
+    Args:
+        old (DevTree or Snapshot): earlier tree
+        new (DevTree or Snapshot): later tree
+
+    Returns:
+        list of dicts - {'change', 'ds_id', 'name', 'old', 'new'} where
+        change is one of added, removed, enabled, disabled, ip, zone,
+        parent or last_time. Changes follow the new tree order, removed
+        datasources the old one.
+    """
+    old_cols = _columns(old)
+    new_cols = _columns(new)
+    old_ids = _by_id(old_cols['ds_id'])
+    new_ids = _by_id(new_cols['ds_id'])
+    changes = []
+
+    def change(kind, cols, pos, old_value=None, new_value=None):
+        changes.append({'change': kind, 'ds_id': cols['ds_id'][pos],
+                        'name': cols['name'][pos], 'old': old_value,
+                        'new': new_value})
+
+    for ds_id, new_pos in new_ids.items():
+        old_pos = old_ids.get(ds_id)
+        if old_pos is None:
+            change('added', new_cols, new_pos)
+            continue
+        old_state = old_cols['enabled'][old_pos]
+        new_state = new_cols['enabled'][new_pos]
+        if old_state != new_state:
+            change('disabled' if new_state == 'F' else 'enabled', new_cols,
+                   new_pos, old_state, new_state)
+        for kind, field in MOVES:
+            old_value = old_cols[field][old_pos]
+            new_value = new_cols[field][new_pos]
+            if old_value != new_value:
+                change(kind, new_cols, new_pos, old_value, new_value)
+        old_time = old_cols['last_time'][old_pos]
+        new_time = new_cols['last_time'][new_pos]
+        if _time_regressed(old_time, new_time):
+            change('last_time', new_cols, new_pos, old_time, new_time)
+
+    removed = old_ids.keys() - new_ids.keys()
+    for ds_id, old_pos in old_ids.items():
+        if ds_id in removed:
+            change('removed', old_cols, old_pos)
+    return changes
@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import bisect
 import csv
 import json
+import logging
 import os
-import re
+import random
 import requests
 import sys
+import threading
+import time
 import urllib.parse as urlparse
-from io import StringIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from configparser import ConfigParser
+from esmcheckds2.cache import cache_dir, cache_key, read_json, write_json
+from esmcheckds2.limiter import AIMDLimiter
+from esmcheckds2.profiler import Profiler
 
 
 requests.packages.urllib3.disable_warnings()
@@ -93,8 +104,59 @@ class ESM(object):
     """
     """
 
-    def __init__(self, cfg, api_ver='v2'):
+    # Methods that are safe to send again after a failure.
+    retry_methods = {'essmgtGetESSTime',
+                     'zoneGetZoneTree',
+                     'GRP%5FGETVIRTUALGROUPIPSLISTDATA',
+                     'GRP_GETVIRTUALGROUPIPSLISTDATA',
+                     'QRY%5FGETDEVICELASTALERTTIME',
+                     'DS_GETDSCLIENTLIST',
+                     'MISC_READFILE',
+                     'ESSMGT_DELETEFILE'}
+
+    # Responses that mean the ESM or a proxy is busy, not that the
+    # request is bad.
+    retry_status = {429, 502, 503, 504}
+
+    # Failures of the connection rather than of the request: refused,
+    # reset, timed out or cut off in the middle of the response body.
+    transport_errors = (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.ContentDecodingError)
+
+    # Methods that leave a temp file on the ESM whose token only comes
+    # back in the response. A busy response means the ESM did not run
+    # them, so they are retried then, but not after a lost response: the
+    # ESM may have written a file no one could delete.
+    creates_file = {'DS_GETDSCLIENTLIST'}
+
+    def __init__(self, cfg, api_ver='v2', profiler=None, retries=3,
+                 backoff=0.5, max_backoff=30, limiter=None,
+                 session_cache=False, relogin=False, connect_timeout=10,
+                 read_timeout=300):
         """
+        Args:
+            cfg (Config or dict): esmhost, esmuser and esmpass
+            api_ver (str): 'v2' or None for the original API path
+            profiler (Profiler): collects call and timing stats.
+                                 A new one is created if not provided.
+            retries (int): extra attempts for retry_methods after a
+                           connection error or busy response
+            backoff (float): base delay in seconds between attempts
+            max_backoff (float): upper bound of the delay
+            limiter (AIMDLimiter): shared concurrency limit for requests.
+                                   A new one is created if not provided.
+            session_cache (bool): reuse the session of a previous run
+                                  and keep this one for the next. The
+                                  ESM logs in again if it is rejected.
+            relogin (bool): log in again when the ESM rejects the
+                            session, for long running processes.
+                            Implied by session_cache.
+            connect_timeout (float): seconds to wait for a connection
+            read_timeout (float): seconds to wait for the ESM to send
+                                  data. A timed out read counts as a
+                                  failed attempt.
         """
         try:
             hostname = cfg['esmhost']
@@ -106,6 +168,14 @@ class ESM(object):
             password = cfg.esmpass
 
         self.api_ver = api_ver
+        self.host = hostname
+        self._user = username
+        self.profiler = profiler or Profiler()
+        self.limiter = limiter or AIMDLimiter()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = (connect_timeout, read_timeout)
 
         if self.api_ver == 'v2':
             self._base_url = 'https://{}/rs/esm/v2/'.format(hostname)
@@ -120,8 +190,18 @@ class ESM(object):
                         "locale": "en_US",
                         "os": "Win32"}
         self._headers = {'Content-Type': 'application/json'}
-
+        self._login_lock = threading.Lock()
+        self.relogin = relogin or session_cache
+
+        self._session_file = None
+        if session_cache:
+            self._session_file = os.path.join(
+                cache_dir(),
+                'session-{}.json'.format(cache_key(hostname, username)))
+            if self._load_session():
+                return
         self._login()
+        self._save_session()
 
     def _login(self):
         """
@@ -142,12 +222,61 @@ class ESM(object):
         self._headers['Cookie'] = resp.headers.get('Set-Cookie')
         self._headers['X-Xsrf-Token'] = resp.headers.get('Xsrf-Token')
 
+    def _load_session(self):
+        """
+        Pick up the Cookie/X-Xsrf-Token pair saved by a previous run.
+
+        Returns:
+            bool. True if a session for this host and user was found.
+        """
+        session = read_json(self._session_file)
+        if not session:
+            return False
+        if (session.get('host') != self.host
+                or session.get('user') != self._user
+                or not session.get('cookie')):
+            return False
+        self._headers['Cookie'] = session['cookie']
+        self._headers['X-Xsrf-Token'] = session.get('xsrf')
+        return True
+
+    def _save_session(self):
+        if not self._session_file:
+            return
+        session = {'host': self.host,
+                   'user': self._user,
+                   'cookie': self._headers.get('Cookie'),
+                   'xsrf': self._headers.get('X-Xsrf-Token'),
+                   'saved': time.time()}
+        try:
+            write_json(self._session_file, session, 0o600)
+        except OSError:
+            print('Could not write to file: {}'.format(self._session_file))
+
+    def _relogin(self, cookie):
+        """
+        Log in again after the ESM rejected a session. Threads that hit
+        the same expired session only trigger one login.
+
+        Args:
+            cookie (str): the Cookie header the rejected request used
+        """
+        with self._login_lock:
+            if self._headers.get('Cookie') == cookie:
+                self._login()
+                self._save_session()
+
     def logout(self):
         """
-        Logout of the ESM.
+        Logout of the ESM and forget any cached session.
         """
         method = self._base_url + 'logout'
         self._delete(method)
+        if self._session_file:
+            try:
+                os.remove(self._session_file)
+            except OSError:
+                pass
 
     def time(self):
         """
@@ -163,15 +292,32 @@ class ESM(object):
     def _delete(self, url, headers=None, verify=False):
         if not headers:
             headers = self._headers
+        start = time.perf_counter()
         try:
-            return requests.delete(url, headers=headers, verify=verify)
-        except requests.exceptions.ConnectionError:
+            resp = requests.delete(url, headers=headers, verify=verify,
+                                   timeout=self.timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            self.profiler.record_http(0, 0, time.perf_counter() - start)
             print("Unable to connect to ESM: {}".format(url))
             sys.exit(1)
+        self.profiler.record_http(0, len(resp.content),
+                                  time.perf_counter() - start,
+                                  resp.status_code)
+        return resp
 
     def post(self, method, data=None, callback=None, raw=None,
              headers=None, verify=False):
-
+        start = time.perf_counter()
+        try:
+            return self._post_method(method, data=data, callback=callback,
+                                     raw=raw, verify=verify)
+        finally:
+            self.profiler.record_method(method,
+                                        time.perf_counter() - start)
+
+    def _post_method(self, method, data=None, callback=None, raw=None,
+                     verify=False):
         if method.isupper():
             url = self._int_url
             data = self._format_params(method, **data)
@@ -180,29 +326,42 @@ class ESM(object):
             if data:
                 data = json.dumps(data)
 
-        resp = self._post(url, data=data,
-                          headers=self._headers, verify=verify)
+        retries = self.retries if method in self.retry_methods else 0
+        cookie = self._headers.get('Cookie')
+        resend = method not in self.creates_file
+        resp = self._post(url, data=data, headers=self._headers,
+                          verify=verify, retries=retries, resend=resend,
+                          method=method)
+
+        if (resp.status_code == 401 and self.relogin
+                and method != 'login'):
+            self._relogin(cookie)
+            resp = self._post(url, data=data, headers=self._headers,
+                              verify=verify, retries=retries,
+                              resend=resend, method=method)
 
         if raw:
             return resp
 
         if 200 <= resp.status_code <= 300:
-            try:
-                resp = resp.json()
-                if isinstance(resp, list):
-                    return resp
-
-                if resp.get('value'):
-                    resp = resp.get('value')
-                elif resp.get('return'):
-                    resp = resp.get('return')
-                    return resp
+            # Internal (uppercase) ESS methods never answer with JSON so
+            # pick the decoder up front instead of failing over.
+            if method.isupper():
+                resp = self._format_resp(self._resp_text(resp))
+            else:
+                try:
+                    resp = resp.json()
+                    if isinstance(resp, list):
+                        return resp
 
-            except json.decoder.JSONDecodeError:
-                resp = resp.text
+                    if resp.get('value'):
+                        resp = resp.get('value')
+                    elif resp.get('return'):
+                        resp = resp.get('return')
+                        return resp
 
-            if method.isupper():
-                resp = self._format_resp(resp)
+                except json.decoder.JSONDecodeError:
+                    resp = resp.text
 
             if 'value' in resp:
                 resp = resp.get('value')
@@ -218,8 +377,8 @@ class ESM(object):
             print('ESM Error:', resp.text)
             sys.exit(1)
 
-    @staticmethod
-    def _post(url, data=None, headers=None, verify=False):
+    def _post(self, url, data=None, headers=None, verify=False,
+              retries=0, resend=True, method=None):
         """
         Method that actually kicks off the HTTP client.
 
@@ -229,17 +388,90 @@ class ESM(object):
             headers (str): http headers that hold cookie data after
                             authentication.
             verify (bool): SSL cerificate verification
+            retries (int): extra attempts after a connection error or
+                           a busy response
+            resend (bool): also retry after a connection error or
+                           timeout, when the ESM may have run the request
+            method (str): ESM method, for the concurrency limiter
 
         Returns:
             Requests Response object
         """
-        try:
-            return requests.post(url, data=data, headers=headers,
-                                 verify=verify)
-
-        except requests.exceptions.ConnectionError:
+        for attempt in range(retries + 1):
+            resp = self._send(url, data=data, headers=headers,
+                              verify=verify, method=method)
+            if resp is not None and resp.status_code not in self.retry_status:
+                return resp
+            if resp is None and not resend:
+                break
+            if attempt < retries:
+                time.sleep(self._backoff_delay(attempt, resp))
+
+        if resp is None:
             print("Unable to connect to ESM: {}".format(url))
             sys.exit(1)
+        return resp
+
+    def _send(self, url, data=None, headers=None, verify=False,
+              method=None):
+        """
+        Send a single post within the concurrency limit. The limiter
+        compares its latency with earlier calls of the same method and
+        a similar response size (within a factor of four).
+
+        Returns:
+            Requests Response object or None if the connection failed
+        """
+        req_bytes = len(data) if data else 0
+        self.limiter.acquire()
+        start = time.perf_counter()
+        resp = None
+        try:
+            resp = requests.post(url, data=data, headers=headers,
+                                 verify=verify, timeout=self.timeout)
+        except self.transport_errors:
+            pass
+        finally:
+            # Also runs for errors passed on to the caller (Ctrl-C...),
+            # so the slot is never lost.
+            latency = time.perf_counter() - start
+            if resp is None:
+                # Already congestion; a lost or timed out response says
+                # nothing about how long the method normally takes.
+                self.limiter.release(error=True)
+            else:
+                self.limiter.release(
+                    latency, error=resp.status_code in self.retry_status,
+                    key=(method, len(resp.content).bit_length() // 2))
+
+        if resp is None:
+            self.profiler.record_http(req_bytes, 0, latency)
+            return None
+        self.profiler.record_http(req_bytes, len(resp.content), latency,
+                                  resp.status_code)
+        return resp
+
+    def _backoff_delay(self, attempt, resp=None):
+        """
+        Full jitter exponential backoff. A numeric Retry-After header
+        from the ESM wins if it asks for a longer wait.
+
+        Args:
+            attempt (int): zero based attempt that just failed
+            resp (Response): the busy response, if any
+
+        Returns:
+            float. Seconds to wait before the next attempt.
+        """
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        if resp is not None:
+            try:
+                retry_after = float(resp.headers.get('Retry-After', 0))
+            except ValueError:
+                retry_after = 0
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
 
     @staticmethod
     def _format_params(cmd, **params):
@@ -257,35 +489,104 @@ class ESM(object):
             params = 'Request=API%13' + cmd + '%13%14'
         return params
 
+    @staticmethod
+    def _resp_text(resp):
+        """
+        Body of an ESS response as text. ESS bodies are percent-encoded
+        ASCII, so skip the charset detection requests falls back to when
+        the ESM does not declare one.
+        """
+        if resp.encoding:
+            return resp.text
+        return resp.content.decode('utf-8', 'replace')
+
     @staticmethod
     def _format_resp(resp):
         """
         Format API response
+
+        The body looks like Response=KEY%13VALUE%13%14KEY%13VALUE%13%14...
+        Walk it once, slicing each key and value straight out of the body.
         """
-        resp = re.search('Response=(.*)', resp).group(1)
-        resp = resp.replace('%14', ' ')
-        pairs = resp.split()
+        start = resp.find('Response=')
+        if start == -1:
+            return {}
+        pos = start + len('Response=')
+        end = resp.find('\n', pos)
+        if end == -1:
+            end = len(resp)
+
         formatted = {}
-        for pair in pairs:
-            pair = pair.replace('%13', ' ')
-            pair = pair.split()
-            key = pair[0]
+        while pos < end:
+            pair_end = resp.find('%14', pos, end)
+            if pair_end == -1:
+                pair_end = end
+            key_end = resp.find('%13', pos, pair_end)
+            if key_end == -1:
+                key = value = resp[pos:pair_end].strip()
+            else:
+                key = resp[pos:key_end].strip()
+                val_end = resp.find('%13', key_end + 3, pair_end)
+                if val_end == -1:
+                    val_end = pair_end
+                value = resp[key_end + 3:val_end]
+            pos = pair_end + 3
+            if not key:
+                continue
             if key == 'ITEMS':
-                value = dehexify(pair[-1])
+                value = dehexify(value)
             else:
-                value = urlparse.unquote(pair[-1])
+                value = urlparse.unquote(value)
             formatted[key] = value
         return formatted
 
 
 class DevTree(object):
-    def __init__(self, esm):
+    def __init__(self, esm, client_cache=False, client_max_age=86400,
+                 parse_workers=0, parse_threshold=1048576):
+        """
+        Args:
+            esm (ESM): logged in ESM instance
+            client_cache (bool): keep client lists between runs and only
+                                 refetch containers whose client count or
+                                 fingerprint changed
+            client_max_age (int): seconds after which a cached container
+                                  is refetched anyway
+            parse_workers (int): processes for decoding and parsing large
+                                 client lists. 0 parses in the fetching
+                                 thread.
+            parse_threshold (int): client lists of at least this many
+                                   bytes go to the process pool
+        """
         self.esm = esm
+        self.parse_workers = parse_workers
+        self.parse_threshold = parse_threshold
+        self._parse_pool = None
+        # ESM temp files not deleted yet, mapped to their pending delete.
+        self._temp_files = {}
+        self._temp_lock = threading.Lock()
+        self._cleanup_pool = None
+        # Held while refresh_times() updates the tree in place.
+        self.lock = threading.RLock()
+        # Pool for the low cardinality fields (vendor, model, type_id,
+        # enabled, tz_id...) so 200k rows share a few hundred strings.
+        self._strings = {}
+        self.client_max_age = client_max_age
+        self._client_cache_file = None
+        self._client_cache = {}
+        if client_cache:
+            # Per user too: accounts may see different client lists.
+            self._client_cache_file = os.path.join(
+                cache_dir(), 'clients-{}.json'.format(
+                    cache_key(esm.host, esm._user)))
+            self._load_client_cache()
         self.build_devtree()
         self._build_summary()
         self._build_name_hash()
         self._build_ip_hash()
         self._build_dsid_hash()
+        self._build_indexes()
+        self._build_time_index()
 
     def _build_summary(self):
         self.summary = set()
@@ -303,6 +604,175 @@ class DevTree(object):
     def _build_dsid_hash(self):
         self.id = {dev['ds_id']: dev for dev in self.devtree}
 
+    # Fields select() can filter on and the aliases it accepts for them.
+    indexed_fields = ('name', 'ds_ip', 'ds_id', 'desc_id', 'type_id',
+                      'enabled', 'zone_name', 'parent_id', 'parent_name')
+    field_aliases = {'ip': 'ds_ip',
+                     'zone': 'zone_name',
+                     'parent': 'parent_name'}
+
+    def _build_indexes(self):
+        """
+        Multi-valued indexes: field -> value -> positions in the tree.
+        Unlike the name/ip/id hashes these keep every device for a key.
+        """
+        self._indexes = {field: {} for field in self.indexed_fields}
+        indexes = [(field, self._indexes[field])
+                   for field in self.indexed_fields]
+        for pos, dev in enumerate(self.devtree):
+            for field, index in indexes:
+                index.setdefault(dev.get(field), []).append(pos)
+
+    def _build_time_index(self):
+        """
+        Tree positions sorted by last event time, so idle and range
+        questions are a bisect instead of a scan. Devices that never
+        sent an event, and those without a last time at all, are kept
+        separately.
+        """
+        stamps = []
+        self._never = []
+        self._untimed = []
+        for pos, dev in enumerate(self.devtree):
+            last_time = dev.get('last_time')
+            if last_time == 'never':
+                self._never.append(pos)
+            elif no_last_time(last_time):
+                self._untimed.append(pos)
+            else:
+                stamp = parse_time(last_time)
+                if stamp is not None:
+                    stamps.append((stamp, pos))
+        stamps.sort()
+        self._time_keys = [stamp for stamp, _ in stamps]
+        self._time_pos = [pos for _, pos in stamps]
+
+    def _positions(self, field, value):
+        """
+        Returns:
+            set of tree positions where field matches value, or any of
+            value's members for a list, tuple or set.
+        """
+        if field == 'last_before':
+            end = bisect.bisect_left(self._time_keys, value)
+            return set(self._time_pos[:end])
+        if field == 'last_after':
+            start = bisect.bisect_right(self._time_keys, value)
+            return set(self._time_pos[start:])
+        if field == 'never':
+            never = set(self._never)
+            if value:
+                return never
+            return set(range(len(self.devtree))) - never
+
+        field = self.field_aliases.get(field, field)
+        try:
+            index = self._indexes[field]
+        except KeyError:
+            raise ValueError('Cannot select on field: {}'.format(field))
+        if isinstance(value, (list, tuple, set, frozenset)):
+            positions = set()
+            for val in value:
+                positions.update(index.get(val, ()))
+            return positions
+        return set(index.get(value, ()))
+
+    def _select_positions(self, criteria):
+        """
+        Returns:
+            set of tree positions matching every criterion or None when
+            there are no criteria
+        """
+        if not criteria:
+            return None
+        matches = sorted((self._positions(field, value)
+                          for field, value in criteria.items()), key=len)
+        return matches[0].intersection(*matches[1:])
+
+    def select(self, **criteria):
+        """
+        Datasources matching every criterion, using the indexes rather
+        than scanning the tree.
+
+        Args:
+            criteria: field=value pairs. A list, tuple or set value
+                      matches any of its members. last_before and
+                      last_after (datetime) select on the last event
+                      time, never=True on devices without events.
+
+        Example:
+            devtree.select(zone='DMZ', enabled='T', desc_id=['3', '256'])
+            devtree.select(last_after=start, last_before=end)
+
+        Returns:
+            List of datasource dicts in tree order
+        """
+        positions = self._select_positions(criteria)
+        if positions is None:
+            return list(self.devtree)
+        return [self.devtree[pos] for pos in sorted(positions)]
+
+    def idle_counts(self, now, thresholds, group_by, **criteria):
+        """
+        Age histogram per group from one walk of the time index.
+
+        Args:
+            now (datetime): current ESM time
+            thresholds (list): timedeltas in ascending order
+            group_by (str): field to group on, e.g. zone_name
+            criteria: restrict to devices matching select() criteria
+
+        Returns:
+            dict - {group: [total, idle > thresholds[0], ...,
+                            idle > thresholds[-1], never]}. Devices
+            without a last time are idle at every threshold (is_idle()),
+            never is the never reporting part of them.
+        """
+        group_by = self.field_aliases.get(group_by, group_by)
+        allowed = self._select_positions(criteria)
+        if allowed is None:
+            allowed = range(len(self.devtree))
+        counts = {}
+        for pos in sorted(allowed):
+            key = self.devtree[pos].get(group_by)
+            if key not in counts:
+                counts[key] = [0] * (len(thresholds) + 2)
+            counts[key][0] += 1
+        for pos in self._never:
+            if pos in allowed:
+                row = counts[self.devtree[pos].get(group_by)]
+                for col in range(1, len(row)):
+                    row[col] += 1
+        for pos in self._untimed:
+            if pos in allowed:
+                row = counts[self.devtree[pos].get(group_by)]
+                for col in range(1, len(row) - 1):
+                    row[col] += 1
+
+        # Times ascend while cutoffs descend, so the devices idle longer
+        # than thresholds[n] are the first bounds[n] entries of the index.
+        bounds = [bisect.bisect_left(self._time_keys, now - threshold)
+                  for threshold in thresholds]
+        bounds.append(0)
+        for level in range(len(thresholds), 0, -1):
+            for pos in self._time_pos[bounds[level]:bounds[level - 1]]:
+                if pos in allowed:
+                    row = counts[self.devtree[pos].get(group_by)]
+                    for col in range(1, level + 1):
+                        row[col] += 1
+        return counts
+
+    def values(self, field):
+        """
+        Returns:
+            List of the distinct values of an indexed field
+        """
+        field = self.field_aliases.get(field, field)
+        try:
+            return list(self._indexes[field])
+        except KeyError:
+            raise ValueError('Cannot select on field: {}'.format(field))
+
     def __contains__(self, name):
         if name in self.summary:
             return True
@@ -322,21 +792,124 @@ class DevTree(object):
         return [d for d in self.devtree if d['desc_id'] in nitro_dev_id]
 
     def build_devtree(self):
-        devtree = self._get_devtree()
-        devtree = self._format_devtree(devtree)
-        containers = self._get_client_containers(devtree)
-        devtree = self._merge_clients(containers, devtree)
-
-        zonetree = self._get_zonetree()
-        devtree = self._insert_zone_names(zonetree, devtree)
-        zone_map = self._get_zone_map()
-        devtree = self._insert_zone_ids(zone_map, devtree)
-        devtree = self._insert_rec_info(devtree)
-        last_times = self._get_last_times()
-        last_times = self._format_times(last_times)
-        self.devtree = self._insert_ds_last_times(last_times, devtree)
+        """
+        Fetch the ESM data and build the datasource list.
+
+        The ESM time, zone tree, zone map and last times do not depend
+        on each other or on the device tree, so they are fetched in the
+        background while the device tree is fetched and parsed. They are
+        joined when the lookups are applied, making the critical path
+        the slowest call instead of the sum of them.
+
+        Rows stream through the parsing and receiver stages as they are
+        parsed; only the lookup stages hold state (zone and last time
+        indexes), so the rows are materialized once, as the finished
+        tree.
+        """
+        stage = self._run_stage
+        if self.parse_workers:
+            self._parse_pool = _process_pool(self.parse_workers)
+        self._cleanup_pool = ThreadPoolExecutor(
+            max_workers=self.esm.limiter.maximum)
+        try:
+            self._build_devtree(stage)
+        finally:
+            if self._parse_pool:
+                self._parse_pool.shutdown()
+                self._parse_pool = None
+            stage('cleanup', self._cleanup_temp_files)
         return self.devtree
 
+    def _build_devtree(self, stage):
+        with ThreadPoolExecutor(max_workers=self.esm.limiter.maximum) as pool:
+            fetches = [pool.submit(self.esm.time),
+                       pool.submit(stage, 'get_zonetree', self._get_zonetree),
+                       pool.submit(stage, 'get_zone_map', self._get_zone_map),
+                       pool.submit(stage, 'get_last_times',
+                                   self._get_last_times)]
+            try:
+                devtree = stage('get_devtree', self._get_devtree)
+                rows = self._format_devtree(devtree)
+                rows = self._insert_rec_info(rows)
+                # Parsed lazily while merging; keep the parse apart from
+                # the waits on client fetches in the profile.
+                rows = self._timed_rows('format_devtree', rows,
+                                        within='merge_clients')
+                devtree = stage('merge_clients', self._merge_clients,
+                                rows, pool)
+
+                esm_time, zonetree, zone_map, last_times = [
+                    future.result() for future in fetches]
+            except BaseException:
+                for future in fetches:
+                    future.cancel()
+                raise
+
+        self.esm_time = esm_time
+        zones = stage('format_zones', self._format_zones, zonetree)
+        last_times = stage('format_times', self._format_times, last_times)
+        rows = self._insert_zone_names(zones, devtree)
+        rows = self._insert_zone_ids(zone_map, rows)
+        rows = self._insert_ds_last_times(last_times, rows)
+        # Run the lookup stages over the tree in place.
+        stage('insert_lookups', deque, rows, 0)
+        self.devtree = devtree
+        if self._client_cache_file:
+            self._save_client_cache()
+
+    def refresh_times(self):
+        """
+        Refetch the ESM time and the last event times and apply them to
+        the current tree, without fetching the topology again. Readers
+        that need a consistent view hold self.lock.
+
+        Returns:
+            str. The new ESM time
+        """
+        stage = self._run_stage
+        esm_time = self.esm.time()
+        last_times = stage('get_last_times', self._get_last_times)
+        last_times = stage('format_times', self._format_times, last_times)
+        with self.lock:
+            deque(self._insert_ds_last_times(last_times, self.devtree), 0)
+            self._build_time_index()
+            self.esm_time = esm_time
+        return esm_time
+
+    def _run_stage(self, name, func, *args):
+        """
+        Run one build stage under the ESM profiler.
+        """
+        with self.esm.profiler.stage(name):
+            return func(*args)
+
+    def _timed_rows(self, name, rows, within=None):
+        """
+        Pass the rows of a streaming stage through, timing only the work
+        of producing them. That time is profiled as stage name and taken
+        out of the stage within, which drives the iteration.
+
+        Yields:
+            the rows unchanged
+        """
+        rows = iter(rows)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield row
+        except StopIteration:
+            return
+        finally:
+            profiler = self.esm.profiler
+            profiler.add_time(name, elapsed)
+            if within:
+                profiler.add_time(within, -elapsed)
+
     def _get_devtree(self):
         """
         Returns:
@@ -355,12 +928,11 @@ class DevTree(object):
         """
         Parse key fields from raw device strings into datasource dicts
 
-        Returns:
-            List of datasource dicts
+        Yields:
+            datasource dicts
         """
-        devtree = StringIO(devtree['ITEMS'])
-        devtree = csv.reader(devtree, delimiter=',')
-        devtree_lod = []
+        devtree = csv.reader(_iter_lines(devtree['ITEMS']), delimiter=',')
+        intern = self._strings.setdefault
         _ignore_remote_ds = False
 
         for idx, row in enumerate(devtree, start=1):
@@ -394,57 +966,173 @@ class DevTree(object):
                 continue
 
             ds_fields = {'idx': idx,
-                            'desc_id': row[0],
+                            'desc_id': intern(row[0], row[0]),
                             'name': row[1],
                             'ds_id': row[2],
-                            'enabled': row[15],
+                            'enabled': intern(row[15], row[15]),
                             'ds_ip': row[27],
                             'hostname': row[28],
-                            'type_id': row[16],
+                            'type_id': intern(row[16], row[16]),
                             'vendor': '',
                             'model': '',
                             'tz_id': '',
                             'date_order': '',
                             'port': '',
                             'syslog_tls': '',
-                            'client_groups': row[29],
+                            'client_groups': intern(row[29], row[29]),
                             'zone_name': '',
                             'zone_id': '',
                             'client': False
                             }
-            devtree_lod.append(ds_fields)
-        return devtree_lod
+            yield ds_fields
 
-    def _get_client_containers(self, devtree):
+    @staticmethod
+    def _has_clients(ds):
+        """
+        Returns:
+            bool. True for datasources that are client containers
+        """
+        return ds['desc_id'] == "3" and int(ds['client_groups']) > 0
+
+    def _merge_clients(self, devtree, pool):
+        """
+        Collect the streamed devtree and insert the clients of every
+        container right after it. Client fetches start as soon as their
+        container streams past, so they overlap with parsing the rest of
+        the tree; the ESM limiter decides how many requests are actually
+        in flight. Clients take their container's parent.
+
+        Args:
+            devtree (iterable): datasource dicts in ESM order
+            pool (Executor): runs the client fetches
+
+        Returns:
+            List of datasource dicts - the devtree
+        """
+        tree = []
+        pending = []
+        try:
+            for ds in devtree:
+                tree.append(ds)
+                if self._has_clients(ds):
+                    pending.append((len(tree),
+                                    pool.submit(self._fetch_clients, ds)))
+
+            if pending:
+                rows = iter(tree)
+                tree = []
+                taken = 0
+                # idx stays the ESM row number; containers move down by
+                # the clients inserted before them and their clients are
+                # numbered right after them.
+                inserted = 0
+                for pos, future in pending:
+                    tree.extend(islice(rows, pos - taken))
+                    taken = pos
+                    cont = tree[-1]
+                    cont['idx'] += inserted
+                    for offset, client in enumerate(future.result(),
+                                                    start=1):
+                        client['idx'] = cont['idx'] + offset
+                        client['parent_name'] = cont['parent_name']
+                        client['parent_id'] = cont['parent_id']
+                        tree.append(client)
+                        inserted += 1
+                tree.extend(rows)
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            raise
+        return tree
+
+    def _fetch_clients(self, container):
         """
-        Filters DevTree for datasources that have client datasources.
+        Returns:
+            List of client datasource dicts for a container
+        """
+        if self._client_cache_file:
+            cached = self._cached_clients(container)
+            if cached is not None:
+                return [self._client_record(values) for values in cached]
+
+        clients = self._read_clients(container['ds_id'])
+        if self._parse_pool and len(clients) >= self.parse_threshold:
+            # Decoding and parsing are CPU bound; hand large lists to a
+            # worker process so this thread only waits, without the GIL.
+            clients = self._parse_pool.submit(decode_clients,
+                                              clients).result()
+        else:
+            clients = decode_clients(clients)
+        if self._client_cache_file:
+            self._client_cache[container['ds_id']] = {
+                'count': container['client_groups'],
+                'fingerprint': self._container_fingerprint(container),
+                'fetched': time.time(),
+                'clients': clients}
+        return [self._client_record(values) for values in clients]
+
+    @staticmethod
+    def _container_fingerprint(container):
+        """
+        Hash of the container fields that change when its clients do.
+        """
+        fields = ('ds_id', 'name', 'enabled', 'type_id', 'ds_ip',
+                  'hostname', 'client_groups')
+        return cache_key(*[container[field] for field in fields])
 
+    def _cached_clients(self, container):
+        """
         Returns:
-            List of datasource dicts that have clients
-        """
-        return [ds for ds in devtree
-                if ds['desc_id'] == "3"
-                if int(ds['client_groups']) > 0]
-
-
-    def _merge_clients(self, containers, devtree):
-        _cidx = 0
-        _didx = 0
-        for cont in containers:
-            clients = self._get_clients(cont['ds_id'])
-            clients = self._format_clients(clients)
-            cont['idx'] = cont['idx'] + _didx
-            _pidx = cont['idx']
-            _cidx = _pidx + 1
-            for client in clients:
-                client['parent_id'] = cont['ds_id']
-                client['idx'] = _cidx
-                _cidx += 1
-                _didx += 1
-            devtree[_pidx:_pidx] = clients
-        return devtree
+            Client values stored by a previous build, or None when the
+            container changed or its entry is older than client_max_age.
+        """
+        entry = self._client_cache.get(container['ds_id'])
+        if not entry:
+            return None
+        if (entry.get('count') != container['client_groups']
+                or entry.get('fingerprint')
+                    != self._container_fingerprint(container)
+                or time.time() - entry.get('fetched', 0)
+                    > self.client_max_age):
+            return None
+        return entry['clients']
+
+    def _load_client_cache(self):
+        cache = read_json(self._client_cache_file)
+        if (cache and cache.get('host') == self.esm.host
+                and cache.get('fields') == list(self.client_fields)):
+            self._client_cache = cache.get('containers', {})
+
+    def _save_client_cache(self):
+        """
+        Store the client lists of the containers still in the tree.
+        """
+        containers = {ds['ds_id']: self._client_cache[ds['ds_id']]
+                      for ds in self.devtree
+                      if ds['ds_id'] in self._client_cache
+                      and self._has_clients(ds)}
+        cache = {'host': self.esm.host,
+                 'fields': list(self.client_fields),
+                 'containers': containers}
+        try:
+            write_json(self._client_cache_file, cache, 0o600)
+        except OSError:
+            print('Could not write to file: {}'.format(
+                self._client_cache_file))
 
     def _get_clients(self, ds_id):
+        """
+        Get list of client strings.
+
+        Args:
+            ds_id (str): Parent ds_id(s) are collected on init
+
+        Returns:
+            List of strings representing unparsed client datasources
+        """
+        return dehexify(self._read_clients(ds_id))
+
+    def _read_clients(self, ds_id):
         """
         Get list of raw client strings.
 
@@ -453,13 +1141,16 @@ class DevTree(object):
             ftoken (str): Set and used after requesting clients for ds_id
 
         Returns:
-            List of strings representing unparsed client datasources
+            str. Client list as sent by the ESM, still encoded
         """
         method = 'DS_GETDSCLIENTLIST'
         data = {'DSID': ds_id,
                  'SEARCH': ''}
 
         file = self.esm.post(method, data=data)['FTOKEN']
+        # Registered before reading so a failed read is still cleaned up.
+        with self._temp_lock:
+            self._temp_files[file] = None
         pos = 0
         nbytes = 0
         method = 'MISC_READFILE'
@@ -469,11 +1160,8 @@ class DevTree(object):
         resp = self.esm.post(method, data=data)
 
         if resp['FSIZE'] == resp['BREAD']:
-            client_data = resp['DATA']
-            method = 'ESSMGT_DELETEFILE'
-            data = {'FN': file}
-            self.esm.post(method, data=data)
-            return dehexify(client_data)
+            self._delete_later(file)
+            return resp['DATA']
 
         client_data = []
         client_data.append(resp['DATA'])
@@ -491,11 +1179,69 @@ class DevTree(object):
             collected += int(resp['BREAD'])
             client_data.append(resp['DATA'])
 
+        self._delete_later(file)
+        return ''.join(client_data)
+
+    def _delete_file(self, ftoken):
         method = 'ESSMGT_DELETEFILE'
-        data = {'FN': file}
+        data = {'FN': ftoken}
         self.esm.post(method, data=data)
 
-        return dehexify(''.join(client_data))
+    def _delete_later(self, ftoken):
+        """
+        Delete an ESM temp file off the fetch path. During a build the
+        delete runs on the cleanup pool; otherwise it runs right away.
+        """
+        pool = self._cleanup_pool
+        if pool is None:
+            self._delete_file(ftoken)
+            with self._temp_lock:
+                self._temp_files.pop(ftoken, None)
+            return
+        try:
+            future = pool.submit(self._delete_file, ftoken)
+        except RuntimeError:
+            # Pool already shut down; the final sweep picks it up.
+            return
+        with self._temp_lock:
+            self._temp_files[ftoken] = future
+        # Runs after the assignment above, even if the delete already
+        # finished, so a done file is never registered again.
+        future.add_done_callback(
+            lambda done: self._deleted(ftoken, done))
+
+    def _deleted(self, ftoken, future):
+        """
+        Forget a temp file once its queued delete succeeded. A failed
+        delete stays registered for the final sweep to retry.
+        """
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._temp_lock:
+            if self._temp_files.get(ftoken) is future:
+                del self._temp_files[ftoken]
+
+    def _cleanup_temp_files(self):
+        """
+        Wait for the queued deletes and delete whatever is left, e.g.
+        files whose read failed or was interrupted. A failed delete is
+        logged rather than raised so it never hides the build's own
+        error.
+        """
+        pool, self._cleanup_pool = self._cleanup_pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+        with self._temp_lock:
+            leftover = list(self._temp_files)
+        for ftoken in leftover:
+            try:
+                self._delete_file(ftoken)
+            except (Exception, SystemExit) as err:
+                logging.warning('Could not delete ESM temp file {}: {!r}'
+                                .format(ftoken, err))
+            else:
+                with self._temp_lock:
+                    self._temp_files.pop(ftoken, None)
 
 
     def _get_rfile(self, ftoken):
@@ -515,6 +1261,12 @@ class DevTree(object):
         return dehexify(resp['DATA'])
 
 
+    # Client fields in the order _parse_clients returns and the client
+    # cache stores them.
+    client_fields = ('ds_id', 'name', 'enabled', 'ds_ip', 'hostname',
+                     'type_id', 'vendor', 'model', 'tz_id', 'date_order',
+                     'port', 'syslog_tls')
+
     def _format_clients(self, clients):
         """
         Parse key fields from _get_clients() output.
@@ -522,34 +1274,47 @@ class DevTree(object):
         Returns:
             list of dicts
         """
-        clients = StringIO(clients)
-        clients = csv.reader(clients, delimiter=',')
+        return [self._client_record(values)
+                for values in self._parse_clients(clients)]
 
-        clients_lod = []
-        for row in clients:
-            if len(row) < 13:
-                continue
+    @staticmethod
+    def _parse_clients(clients):
+        """
+        Pull the client_fields out of _get_clients() output.
+
+        Returns:
+            list of tuples
+        """
+        clients = csv.reader(_iter_lines(clients), delimiter=',')
+        return [(row[0], row[1], row[2], row[3], row[4], row[5], row[6],
+                 row[7], row[8], row[9], row[11], row[12])
+                for row in clients if len(row) >= 13]
 
-            ds_fields = {'desc_id': "256",
-                          'name': row[1],
-                          'ds_id': row[0],
-                          'enabled': row[2],
-                          'ds_ip': row[3],
-                          'hostname': row[4],
-                          'type_id': row[5],
-                          'vendor': row[6],
-                          'model': row[7],
-                          'tz_id': row[8],
-                          'date_order': row[9],
-                          'port': row[11],
-                          'syslog_tls': row[12],
-                          'client_groups': "0",
-                          'zone_name': '',
-                          'zone_id': '',
-                          'client': True
-                        }
-            clients_lod.append(ds_fields)
-        return clients_lod
+    def _client_record(self, values):
+        """
+        Build a client datasource dict from client_fields values.
+        """
+        (ds_id, name, enabled, ds_ip, hostname, type_id, vendor, model,
+         tz_id, date_order, port, syslog_tls) = values
+        intern = self._strings.setdefault
+        return {'desc_id': "256",
+                'name': name,
+                'ds_id': ds_id,
+                'enabled': intern(enabled, enabled),
+                'ds_ip': ds_ip,
+                'hostname': hostname,
+                'type_id': intern(type_id, type_id),
+                'vendor': intern(vendor, vendor),
+                'model': intern(model, model),
+                'tz_id': intern(tz_id, tz_id),
+                'date_order': intern(date_order, date_order),
+                'port': intern(port, port),
+                'syslog_tls': intern(syslog_tls, syslog_tls),
+                'client_groups': "0",
+                'zone_name': '',
+                'zone_id': '',
+                'client': True
+                }
 
     def _get_zonetree(self):
         """
@@ -568,28 +1333,41 @@ class DevTree(object):
         resp = self.esm.post(method, data=data)
         return dehexify(resp['ITEMS'])
 
-    def _insert_zone_names(self, zonetree, devtree):
+    def _format_zones(self, zonetree):
         """
         Args:
             zonetree (str): Built by self._get_zonetree
 
         Returns:
-            List of dicts (str: str) devices by zone
+            dict (str: str) ds_id: zone name
         """
+        zones = {}
         zone_name = None
-        zonetree = StringIO(zonetree)
-        zonetree = csv.reader(zonetree, delimiter=',')
+        zonetree = csv.reader(_iter_lines(zonetree), delimiter=',')
 
         for row in zonetree:
+            if not row:
+                continue
             if row[0] == '1':
                 zone_name = row[1]
                 if zone_name == 'Undefined':
                     zone_name = ''
                 continue
-            for device in devtree:
-                if device['ds_id'] == row[2]:
-                    device['zone_name'] = zone_name
-        return devtree
+            zones[row[2]] = zone_name
+        return zones
+
+    def _insert_zone_names(self, zones, devtree):
+        """
+        Args:
+            zones (dict): Built by self._format_zones
+
+        Yields:
+            datasource dicts with zone_name set
+        """
+        for device in devtree:
+            if device['ds_id'] in zones:
+                device['zone_name'] = zones[device['ds_id']]
+            yield device
 
     def _get_zone_map(self):
         """
@@ -612,13 +1390,12 @@ class DevTree(object):
 
     def _insert_zone_ids(self, zone_map, devtree):
         """
+        Yields:
+            datasource dicts with zone_id set
         """
         for device in devtree:
-            if device['zone_name'] in zone_map.keys():
-                device['zone_id'] = zone_map.get(device['zone_name'])
-            else:
-                device['zone_id'] = '0'
-        return devtree
+            device['zone_id'] = zone_map.get(device['zone_name'], '0')
+            yield device
 
     def _insert_rec_info(self, devtree):
         """
@@ -626,21 +1403,22 @@ class DevTree(object):
         ordered list provided by the ESM. All the datasources below
         a Receiver row have its id set as their parent ID.
 
-        Returns:
-            List of datasource dicts
+        Yields:
+            datasource dicts with parent_name and parent_id set
         """
         esm_dev_id = ['14']
         esm_mfe_dev_id = ['19', '21', '22', '24']
         nitro_dev_id = ['2', '4', '10', '12', '13', '15']
         datasource_dev_id = ['3', '5', '7', '17', '20', '23', '256']
 
-        parent_id = parent_name = None
+        parent_id = parent_name = esm_id = esm_name = None
         for device in devtree:
             if device['desc_id'] in esm_dev_id:
                 esm_name = device['name']
                 esm_id = device['ds_id']
                 device['parent_name'] = 'n/a'
                 device['parent_id'] = '0'
+                yield device
                 continue
 
             if device['desc_id'] in esm_mfe_dev_id:
@@ -648,6 +1426,7 @@ class DevTree(object):
                 parent_id = device['ds_id']
                 device['parent_name'] = 'n/a'
                 device['parent_id'] = '0'
+                yield device
                 continue
 
             if device['desc_id'] in nitro_dev_id:
@@ -655,6 +1434,7 @@ class DevTree(object):
                 device['parent_id'] = esm_id
                 parent_name = device['name']
                 parent_id = device['ds_id']
+                yield device
                 continue
 
             if device['desc_id'] in datasource_dev_id:
@@ -663,8 +1443,7 @@ class DevTree(object):
             else:
                 device['parent_name'] = 'n/a'
                 device['parent_id'] = 'n/a'
-
-        return devtree
+            yield device
 
     def _get_last_times(self):
         """
@@ -682,7 +1461,7 @@ class DevTree(object):
             last_times (str): string output from _get_last_times()
 
         Returns:
-            list of dicts - [{'name', 'model', 'last_time'}]
+            dict - {name: (model, last_time)}
         """
         try:
             last_times = last_times['ITEMS']
@@ -693,35 +1472,142 @@ class DevTree(object):
             print('The "Administrator Rights" box must be checked for the user.')
             sys.exit(1)
 
-        last_times = StringIO(last_times)
-        last_times = csv.reader(last_times, delimiter=',')
-        last_times_lod = []
+        last_times = csv.reader(_iter_lines(last_times), delimiter=',')
+        intern = self._strings.setdefault
+        last_times_d = {}
         for row in last_times:
             if len(row) == 5:
-                time_d = {}
-                time_d['name'] = row[0]
-                time_d['model'] = row[2]
-                if row[3]:
-                    time_d['last_time'] = row[3]
-                else:
-                    time_d['last_time'] = 'never'
-                last_times_lod.append(time_d)
-        return last_times_lod
+                last_times_d[row[0]] = (intern(row[2], row[2]),
+                                        row[3] or 'never')
+        return last_times_d
 
     def _insert_ds_last_times(self, last_times, devtree):
         """
-        Parse event times str and insert it into the _devtree
+        Insert the model and last event time of each device.
 
-        Returns:
-            List of datasource dicts - the devtree
+        Args:
+            last_times (dict): Built by self._format_times
+
+        Yields:
+            datasource dicts
         """
         for device in devtree:
-            for d_time in last_times:
-                if device['name'] == d_time['name']:
-                    device['model'] = d_time['model']
-                    device['last_time'] = d_time['last_time']
-        return devtree
+            if device['name'] in last_times:
+                device['model'], device['last_time'] = last_times[device['name']]
+            yield device
+
+
+def decode_clients(data):
+    """
+    Decode and parse a raw client list. Module level so it can run in a
+    worker process; the tuples it returns are cheap to pickle back.
+
+    Args:
+        data (str): client list as returned by DevTree._read_clients
+
+    Returns:
+        list of tuples in DevTree.client_fields order
+    """
+    return DevTree._parse_clients(dehexify(data))
+
 
+def _process_pool(workers):
+    """
+    Process pool for decode_clients(). Clients are submitted from the
+    fetch threads, so the workers must not be forked then: a child
+    forked while another thread holds a lock (limiter, logging...) can
+    deadlock. They are spawned instead, or on Python < 3.7, which has
+    no mp_context, forked here, before any fetch thread exists.
+
+    Returns:
+        ProcessPoolExecutor
+    """
+    import multiprocessing
+    try:
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:
+        pool = ProcessPoolExecutor(workers)
+        # Python < 3.7 starts every worker on the first submit.
+        pool.submit(int).result()
+        return pool
+
+
+TIME_FORMATS = ('%Y/%m/%d %H:%M:%S',
+                '%m/%d/%Y %H:%M:%S',
+                '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S')
+
+
+@lru_cache(maxsize=65536)
+def parse_time(time_str):
+    """
+    Converts an ESM timestamp string to a datetime object. The formats
+    the ESM uses are tried first; anything else goes to dateutil.
+    Results are cached since many devices share a last time.
+
+    Args:
+        time_str (str): time as a string, e.g. 2019/02/28 22:22:22
+
+    Returns:
+        datetime object or None if the string is not a time
+    """
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            pass
+    try:
+        import dateutil.parser as dateparser
+        return dateparser.parse(time_str)
+    except (ValueError, OverflowError):
+        return None
+
+
+def no_last_time(last_time):
+    """
+    True for devices without a last event time: never reported, n/a or
+    empty.
+    """
+    return not last_time or last_time in ('never', 'n/a')
+
+
+def is_idle(last_time, idle_before=None):
+    """
+    The definition of idle the CLI rows use (filter_by_time), shared by
+    the tree, prom and idle_counts() output so their counts add up to
+    the rows of the same run.
+
+    Args:
+        last_time (str): last event time of a device
+        idle_before (datetime): idle cutoff or None
+
+    Returns:
+        True if the device has no last time or, with a cutoff, its last
+        time is before it. A time that does not parse is not idle.
+    """
+    if no_last_time(last_time):
+        return True
+    if not idle_before:
+        return False
+    stamp = parse_time(last_time)
+    return stamp is not None and stamp < idle_before
+
+
+def _iter_lines(data):
+    """
+    Iterate over the lines of a large string without copying it into a
+    StringIO first.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        nl = data.find('\n', pos)
+        if nl == -1:
+            yield data[pos:]
+            return
+        yield data[pos:nl + 1]
+        pos = nl + 1
 
 
 def dehexify(data):
@@ -732,40 +1618,22 @@ def dehexify(data):
         '\x1c': ',',  # Replacing Device Control 1 with a comma.
         '\x11': ',',  # Replacing Device Control 2 with a new line.
         '\x12': '\n',  # Space
-        '\x22': '"',  # Double Quotes
-        '\x23': '#',  # Number Symbol
-        '\x27': '\'',  # Single Quote
-        '\x28': '(',  # Open Parenthesis
-        '\x29': ')',  # Close Parenthesis
-        '\x2b': '+',  # Plus Symbol
-        '\x2d': '-',  # Hyphen Symbol
-        '\x2e': '.',  # Period, dot, or full stop.
-        '\x2f': '/',  # Forward Slash or divide symbol.
-        '\x7c': '|',  # Vertical bar or pipe.
     }
 
+    # The remaining escapes the ESM uses (%20, %22, %2B, %2F, %3A...) are
+    # plain percent-encoding and are decoded by unquote() below.
     uri = {
         '%11': ',',  # Replacing Device Control 1 with a comma.
         '%12': '\n',  # Replacing Device Control 2 with a new line.
-        '%20': ' ',  # Space
-        '%22': '"',  # Double Quotes
-        '%23': '#',  # Number Symbol
-        '%27': '\'',  # Single Quote
-        '%28': '(',  # Open Parenthesis
-        '%29': ')',  # Close Parenthesis
-        '%2B': '+',  # Plus Symbol
-        '%2D': '-',  # Hyphen Symbol
-        '%2E': '.',  # Period, dot, or full stop.
-        '%2F': '/',  # Forward Slash or divide symbol.
-        '%3A': ':',  # Colon
-        '%7C': '|',  # Vertical bar or pipe.
     }
 
     for (enc, dec) in hexen.items():
-        data = data.replace(enc, dec)
+        if enc in data:
+            data = data.replace(enc, dec)
 
     for (enc, dec) in uri.items():
-        data = data.replace(enc, dec)
+        if enc in data:
+            data = data.replace(enc, dec)
 
     data = urlparse.unquote(data)
 
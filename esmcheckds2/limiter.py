@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+
+class AIMDLimiter(object):
+    """
+    Adaptive concurrency limit for requests to the ESM.
+
+    The limit grows by one request per window of successful calls
+    (additive increase) and is cut in half when a call fails or its
+    latency jumps well above the running average for the same kind of
+    request (multiplicative decrease). Callers block in acquire() while
+    the limit is in use, so any number of worker threads can share one
+    ESM without overloading it.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, decrease=0.5,
+                 tolerance=2.0, smoothing=0.2):
+        """
+        Args:
+            initial (int): starting concurrency limit
+            minimum (int): the limit never drops below this
+            maximum (int): the limit never grows above this
+            decrease (float): factor applied to the limit on congestion
+            tolerance (float): a latency this many times the average
+                               of its kind counts as congestion
+            smoothing (float): weight of each new sample in the average
+        """
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.inflight = 0
+        self.latency = None
+        # Average latency per request kind, see release().
+        self._baselines = {}
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a request slot is available.
+        """
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, latency=None, error=False, key=None):
+        """
+        Return a request slot and adjust the limit.
+
+        Args:
+            latency (float): round trip time of the request in seconds
+            error (bool): the request failed or the ESM was overloaded
+            key (hashable): kind of request, e.g. method and response
+                            size. Latency is only compared with earlier
+                            requests of the same kind, so a large read
+                            taking longer than small ones is not taken
+                            for congestion.
+        """
+        with self._cond:
+            self.inflight -= 1
+            congested = error
+            if latency is not None:
+                baseline = self._baselines.get(key)
+                if baseline is None:
+                    baseline = latency
+                elif latency > baseline * self.tolerance:
+                    congested = True
+                self._baselines[key] = (baseline + self.smoothing
+                                        * (latency - baseline))
+                if self.latency is None:
+                    self.latency = latency
+                self.latency += self.smoothing * (latency - self.latency)
+
+            if congested:
+                # Requests already in flight when the limit drops
+                # report the same congestion; only react once per
+                # round trip.
+                now = time.monotonic()
+                if now - self._last_decrease > (self.latency or 0):
+                    self.limit = max(self.limit * self.decrease,
+                                     self.minimum)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            self._cond.notify_all()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse as urlparse
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """
+    Records where the time goes during a run:
+
+     - wall time per DevTree build stage
+     - calls and wall time per ESM/ESS method
+     - HTTP call counts, request/response bytes and latencies
+
+    Every ESM instance carries one, so library callers can pass their
+    own in or read esm.profiler after building a DevTree.
+
+    Latency percentiles come from a fixed size random sample of the
+    calls, so a long running process (esmcheckds2 serve) keeps a
+    bounded amount of memory. They are exact up to sample_size calls.
+    """
+
+    percentiles = (50, 90, 95, 99)
+
+    def __init__(self, sample_size=10000):
+        """
+        Initialize a Profiler instance.
+
+        Args:
+            sample_size (int): latencies kept for the percentiles
+        """
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.methods = OrderedDict()
+        self.http_calls = 0
+        self.http_errors = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.sample_size = sample_size
+        self._latencies = []
+        self._latency_max = 0.0
+        self._latency_total = 0.0
+        self._random = random.Random()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a named stage. Repeated stages accumulate.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        """
+        Add seconds to a stage, e.g. time measured piecewise. Negative
+        seconds take time back out of a stage.
+        """
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record_method(self, method, seconds):
+        """
+        Args:
+            method (str): ESM method name as passed to ESM.post
+            seconds (float): wall time including response decoding
+        """
+        method = urlparse.unquote(method)
+        with self._lock:
+            stats = self.methods.setdefault(method, {'calls': 0,
+                                                     'seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+
+    def record_http(self, request_bytes, response_bytes, seconds,
+                    status=None):
+        """
+        Args:
+            request_bytes (int): size of the request body
+            response_bytes (int): size of the response body
+            seconds (float): round trip latency
+            status (int): HTTP status code or None if no response
+        """
+        with self._lock:
+            self.http_calls += 1
+            self.request_bytes += request_bytes
+            self.response_bytes += response_bytes
+            self._latency_max = max(self._latency_max, seconds)
+            self._latency_total += seconds
+            # Reservoir sampling: every call so far is equally likely to
+            # be in the sample.
+            if len(self._latencies) < self.sample_size:
+                self._latencies.append(seconds)
+            else:
+                slot = self._random.randrange(self.http_calls)
+                if slot < self.sample_size:
+                    self._latencies[slot] = seconds
+            if status is None or status >= 400:
+                self.http_errors += 1
+
+    def elapsed(self):
+        """
+        Returns:
+            float. Seconds since the Profiler was created.
+        """
+        return time.perf_counter() - self._start
+
+    def latency(self):
+        """
+        Returns:
+            dict of latency percentiles (nearest rank) in seconds, with
+            the exact max and total.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            latency_max = self._latency_max
+            latency_total = self._latency_total
+        if not latencies:
+            return {}
+        pcts = OrderedDict()
+        for pct in self.percentiles:
+            rank = max(int(round(pct / 100 * len(latencies))), 1)
+            pcts['p{}'.format(pct)] = latencies[rank - 1]
+        pcts['max'] = latency_max
+        pcts['total'] = latency_total
+        return pcts
+
+    def summary(self):
+        """
+        Returns:
+            dict suitable for json.dumps
+        """
+        with self._lock:
+            stages = OrderedDict(self.stages)
+            methods = OrderedDict((m, dict(s))
+                                  for m, s in self.methods.items())
+            http = OrderedDict([('calls', self.http_calls),
+                                ('errors', self.http_errors),
+                                ('request_bytes', self.request_bytes),
+                                ('response_bytes', self.response_bytes)])
+        http['latency'] = self.latency()
+        return OrderedDict([('started', time.strftime(
+                                '%Y-%m-%dT%H:%M:%SZ',
+                                time.gmtime(self.started))),
+                            ('elapsed', self.elapsed()),
+                            ('stages', stages),
+                            ('methods', methods),
+                            ('http', http)])
+
+    def write(self, filename=None):
+        """
+        Write the summary as JSON.
+
+        Args:
+            filename (str): destination file. None or '-' for stderr.
+        """
+        summary = json.dumps(self.summary(), indent=2)
+        if filename in (None, '-'):
+            print(summary, file=sys.stderr)
+            return
+        try:
+            with open(filename, 'w') as open_f:
+                open_f.write(summary + '\n')
+        except OSError:
+            print('Could not write to file: {}'.format(filename))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+from collections import OrderedDict
+from esmcheckds2.cache import atomic_write
+from esmcheckds2.esmcheckds2 import is_idle, parse_time
+
+
+PREFIX = 'esmcheckds2_'
+
+
+def _escape(value):
+    """
+    Escape a label value for the Prometheus text exposition format.
+    """
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(key, _escape(val))
+                    for key, val in labels.items())
+
+
+def _sample(name, value, labels=None):
+    if value == float('inf'):
+        value = '+Inf'
+    if labels:
+        return '{}{}{{{}}} {}'.format(PREFIX, name, labels, value)
+    return '{}{} {}'.format(PREFIX, name, value)
+
+
+def format_prom(datasources, now, idle_before=None, esm=None, host=None,
+                profiler=None):
+    """
+    Builds a Prometheus exposition document in one pass over the
+    datasources.
+
+    Args:
+        datasources (iterable): datasource dicts from a DevTree
+        now (datetime): ESM time (GMT)
+        idle_before (datetime): datasources with a last time before this
+                                count as idle. Datasources without a
+                                last time always do, as in the CLI
+                                rows.
+        esm (ESM): source of the run duration and HTTP stats
+        host (str): ESM host used as a label on the run metrics
+        profiler (Profiler): run stats when there is no ESM, e.g. for a
+                             tree read from a shared snapshot
+
+    Returns:
+        str. Prometheus text exposition format
+    """
+    metrics = OrderedDict()
+
+    def metric(name, mtype, helptext):
+        return metrics.setdefault(name, ['# HELP {}{} {}'
+                                         .format(PREFIX, name, helptext),
+                                         '# TYPE {}{} {}'
+                                         .format(PREFIX, name, mtype)])
+
+    age = metric('datasource_last_event_age_seconds', 'gauge',
+                 'Seconds since the datasource last sent an event.')
+    totals = OrderedDict()
+    for ds in datasources:
+        group = (ds['zone_name'], ds['parent_name'])
+        counts = totals.setdefault(group, [0, 0])
+        counts[0] += 1
+        last_time = ds.get('last_time')
+        if is_idle(last_time, idle_before):
+            counts[1] += 1
+        if not last_time or last_time == 'n/a':
+            continue
+        if last_time == 'never':
+            seconds = float('inf')
+        else:
+            last_time = parse_time(last_time)
+            if last_time is None:
+                continue
+            seconds = int((now - last_time).total_seconds())
+        age.append(_sample('datasource_last_event_age_seconds', seconds,
+                           _labels(name=ds['name'], ds_id=ds['ds_id'],
+                                   zone=ds['zone_name'],
+                                   parent=ds['parent_name'],
+                                   type=ds['model'])))
+
+    total = metric('datasources', 'gauge',
+                   'Datasources per zone and parent device.')
+    idle = metric('datasources_idle', 'gauge',
+                  'Idle datasources per zone and parent device, '
+                  'including those without a last event time.')
+    for (zone, parent), (count, idle_count) in totals.items():
+        labels = _labels(zone=zone, parent=parent)
+        total.append(_sample('datasources', count, labels))
+        idle.append(_sample('datasources_idle', idle_count, labels))
+
+    esm_label = _labels(esm=host) if host else None
+    if idle_before:
+        metric('idle_threshold_seconds', 'gauge',
+               'Age after which a datasource counts as idle.').append(
+            _sample('idle_threshold_seconds',
+                    int((now - idle_before).total_seconds()), esm_label))
+
+    if profiler is None and esm is not None:
+        profiler = esm.profiler
+    if profiler is not None:
+        run = [('run_duration_seconds',
+                'Wall time of the esmcheckds2 run.',
+                profiler.elapsed()),
+               ('run_http_requests',
+                'HTTP requests sent to the ESM during the run.',
+                profiler.http_calls),
+               ('run_http_errors',
+                'Failed HTTP requests during the run.',
+                profiler.http_errors),
+               ('run_http_request_bytes',
+                'Request bytes sent to the ESM during the run.',
+                profiler.request_bytes),
+               ('run_http_response_bytes',
+                'Response bytes received from the ESM during the run.',
+                profiler.response_bytes)]
+        for name, helptext, value in run:
+            metric(name, 'gauge', helptext).append(
+                _sample(name, value, esm_label))
+
+        latency = metric('run_http_latency_seconds', 'summary',
+                         'HTTP round trip latency to the ESM.')
+        pcts = profiler.latency()
+        host_label = {'esm': host} if host else {}
+        for pct in profiler.percentiles:
+            key = 'p{}'.format(pct)
+            if key in pcts:
+                latency.append(_sample('run_http_latency_seconds',
+                                       pcts[key],
+                                       _labels(quantile=pct / 100,
+                                               **host_label)))
+        latency.append(_sample('run_http_latency_seconds_count',
+                               profiler.http_calls, esm_label))
+        latency.append(_sample('run_http_latency_seconds_sum',
+                               pcts.get('total', 0), esm_label))
+
+    metric('last_run_timestamp_seconds', 'gauge',
+           'Unix time the esmcheckds2 run finished.').append(
+        _sample('last_run_timestamp_seconds', int(time.time()), esm_label))
+
+    return '\n'.join(line for lines in metrics.values()
+                     for line in lines) + '\n'
+
+
+def write_prom(filename, text):
+    """
+    Atomically replace filename with text so the node_exporter textfile
+    collector never reads a partial file.
+
+    Args:
+        filename (str): destination .prom file. None, False or '-' for
+                        stdout.
+        text (str): output of format_prom()
+    """
+    if not filename or filename == '-':
+        sys.stdout.write(text)
+        return
+    try:
+        atomic_write(filename, text, 0o644)
+    except OSError:
+        print('Could not write to file: {}'.format(filename))
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+from esmcheckds2.console import (datasource_criteria, filter_by_time,
+                                 time_window)
+from esmcheckds2.esmcheckds2 import DevTree
+
+
+# Datasource fields returned by /datasources, in the CLI column order.
+FIELDS = ('name', 'ds_ip', 'model', 'parent_name', 'zone_name', 'last_time')
+
+# Query parameters taking a number and those that act as flags.
+INT_PARAMS = ('days', 'hours', 'minutes')
+FLAG_PARAMS = ('disabled', 'mfe', 'siem', 'future', 'dsid')
+
+
+class QueryError(ValueError):
+    """
+    Invalid query parameters; answered with HTTP 400.
+    """
+
+
+def _esm_datetime(esm_time):
+    return datetime.strptime(esm_time[:-7], '%Y-%m-%dT%H:%M:%S')
+
+
+def _flag(value):
+    # A bare ?dsid arrives as '' and means on, like the CLI switch.
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is only in Python 3.7+.
+    daemon_threads = True
+
+
+class TreeServer(object):
+    """
+    Keeps one DevTree in memory for many clients.
+
+    A background thread rebuilds the whole tree every topology_interval
+    seconds and, in between, only refetches the last event times every
+    times_interval seconds. A failed refresh is logged and the previous
+    data is served until the next one succeeds.
+    """
+
+    def __init__(self, esm, tree_opts=None, topology_interval=3600,
+                 times_interval=300):
+        """
+        Args:
+            esm (ESM): logged in ESM instance, ideally with relogin=True
+            tree_opts (dict): keyword arguments for DevTree
+            topology_interval (int): seconds between full rebuilds
+            times_interval (int): seconds between last time refreshes
+        """
+        self.esm = esm
+        self.tree_opts = tree_opts or {}
+        self.topology_interval = topology_interval
+        self.times_interval = times_interval
+        self.devtree = None
+        self.refreshed = {'topology': None, 'times': None}
+        self.last_error = None
+        # ESM time of the last refresh and the monotonic clock reading
+        # it was taken at, so now() keeps ticking between refreshes.
+        self._clock = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._httpd = None
+
+    def start(self):
+        """
+        Build the first tree in the foreground, so startup errors reach
+        the caller, then start the refresh thread.
+        """
+        self.refresh_topology()
+        self._thread = threading.Thread(target=self._refresh_loop,
+                                        name='refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def serve_forever(self, bind='127.0.0.1', port=8080):
+        """
+        Answer HTTP requests until stop() is called or Ctrl-C.
+        """
+        self._httpd = _ThreadingHTTPServer((bind, port), _Handler)
+        self._httpd.tree_server = self
+        self._httpd.serve_forever()
+
+    def refresh_topology(self):
+        """
+        Build a new DevTree and swap it in. Queries keep using the old
+        tree until the new one is complete.
+        """
+        devtree = DevTree(self.esm, **self.tree_opts)
+        self._clock = (_esm_datetime(devtree.esm_time), time.monotonic())
+        self.devtree = devtree
+        self.refreshed['topology'] = self.refreshed['times'] = time.time()
+
+    def refresh_times(self):
+        """
+        Refetch the last event times into the current tree.
+        """
+        esm_time = self.devtree.refresh_times()
+        self._clock = (_esm_datetime(esm_time), time.monotonic())
+        self.refreshed['times'] = time.time()
+
+    def _refresh_loop(self):
+        next_topology = time.monotonic() + self.topology_interval
+        next_times = time.monotonic() + self.times_interval
+        while not self._stop.wait(max(min(next_topology, next_times)
+                                      - time.monotonic(), 0)):
+            now = time.monotonic()
+            if now >= next_topology:
+                job, refresh = 'topology', self.refresh_topology
+            elif now >= next_times:
+                job, refresh = 'times', self.refresh_times
+            else:
+                continue
+            try:
+                refresh()
+                self.last_error = None
+            except (Exception, SystemExit) as err:
+                # ESM errors end in sys.exit(); keep serving the
+                # previous data instead of losing the thread.
+                self.last_error = '{} refresh failed: {!r}'.format(job, err)
+                logging.warning(self.last_error)
+            now = time.monotonic()
+            if job == 'topology':
+                next_topology = now + self.topology_interval
+            next_times = now + self.times_interval
+
+    def now(self):
+        """
+        Returns:
+            datetime. Current ESM time (GMT), from the last refresh plus
+            the time since.
+        """
+        esm_now, taken = self._clock
+        return esm_now + timedelta(seconds=time.monotonic() - taken)
+
+    def status(self):
+        """
+        Returns:
+            dict - refresh times, tree size and the last refresh error
+        """
+        return {'esm': self.esm.host,
+                'esm_time': self.now().isoformat(),
+                'devices': len(self.devtree.devtree),
+                'refreshed': {job: (time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                  time.gmtime(stamp))
+                                    if stamp else None)
+                              for job, stamp in self.refreshed.items()},
+                'error': self.last_error}
+
+    def query(self, params):
+        """
+        Filter the datasources like the CLI does.
+
+        Args:
+            params (dict): query string values; zone, disabled, mfe,
+                           siem, days, hours, minutes, future, dsid
+
+        Returns:
+            dict - ESM time, cutoff and the matching datasources
+
+        Raises:
+            QueryError for unknown or malformed parameters
+        """
+        unknown = set(params) - set(INT_PARAMS + FLAG_PARAMS + ('zone',))
+        if unknown:
+            raise QueryError('Unknown parameter: {}'
+                             .format(', '.join(sorted(unknown))))
+        window = {}
+        for name in INT_PARAMS:
+            if name in params:
+                try:
+                    window[name] = int(params[name])
+                except ValueError:
+                    raise QueryError('{} must be a number'.format(name))
+        flags = {name: _flag(params[name])
+                 for name in FLAG_PARAMS if name in params}
+
+        now = self.now()
+        time_filter = time_window(now, future_only=flags.get('future'),
+                                  **window)
+        fields = FIELDS
+        if flags.get('dsid'):
+            fields = ('name', 'ds_id') + FIELDS[1:]
+
+        devtree = self.devtree
+        with devtree.lock:
+            criteria = datasource_criteria(
+                devtree, zone=params.get('zone'),
+                exclude_disabled=flags.get('disabled'),
+                exclude_mfe=flags.get('mfe'),
+                exclude_siem=flags.get('siem'))
+            matched = filter_by_time(devtree.select(**criteria),
+                                     time_filter, flags.get('future'))
+            rows = [{field: ds.get(field) for field in fields}
+                    for ds in matched]
+        return {'esm': self.esm.host,
+                'esm_time': now.isoformat(),
+                'time_filter': (time_filter.isoformat() if time_filter
+                                else None),
+                'count': len(rows),
+                'datasources': rows}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'esmcheckds2'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        tree_server = self.server.tree_server
+        if url.path == '/datasources':
+            params = {key: values[-1] for key, values
+                      in parse_qs(url.query, keep_blank_values=True).items()}
+            try:
+                self._reply(200, tree_server.query(params))
+            except QueryError as err:
+                self._reply(400, {'error': str(err)})
+        elif url.path == '/status':
+            self._reply(200, tree_server.status())
+        else:
+            self._reply(404, {'error': 'Not found: {}'.format(url.path)})
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
@@ -0,0 +1,658 @@
+# -*- coding: utf-8 -*-
+"""
+Saved device trees.
+
+Two formats are understood. JSON is simple but has to be decoded in
+full on every load. The binary format is columnar and loaded with mmap,
+so opening a snapshot costs a header read no matter how many
+datasources it holds and queries only touch the pages they need:
+
+    header       '<8sII': MAGIC, BINARY_VERSION, length of meta
+    meta         JSON: ESM, ESM time, fields and the section directory
+    sections     8 byte aligned arrays, little endian, offsets in the
+                 directory are relative to the end of meta (padded)
+
+    str_offs     uint32[n + 1]  string table offsets, strings sorted so
+    str_data     bytes          a string's id is its rank
+    col.<field>  uint32 string id per row (NO_VALUE when missing,
+                 NULL_VALUE for None), or int64 per row (NO_INT when
+                 missing) for int fields
+    time_keys    int64   last times (unix seconds), ascending
+    time_pos     uint32  row of each time_keys entry
+    never        uint32  rows whose last time is never
+    index.<field>.keys    uint32  distinct string ids, ascending
+    index.<field>.starts  uint32  start of each key's rows in perm
+    index.<field>.perm    uint32  rows grouped by key, in tree order
+"""
+
+import bisect
+import calendar
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from esmcheckds2.cache import FileLock, atomic_write
+
+SNAPSHOT_VERSION = 1
+BINARY_VERSION = 2
+# Version 1 files have no NULL_VALUE and read the same.
+BINARY_VERSIONS = (1, 2)
+MAGIC = b'ESMSNAP\0'
+HEADER = struct.Struct('<8sII')
+
+NO_VALUE = 0xFFFFFFFF
+NULL_VALUE = 0xFFFFFFFE
+NO_INT = -2 ** 63
+
+# Column types: plain strings, integers and anything else as JSON.
+STR, INT, JSON = 's', 'i', 'j'
+
+_MISSING = object()
+
+
+class Snapshot(object):
+    """
+    A DevTree saved by save_snapshot(). Iterates over the same
+    datasource dicts, so it can stand in for a DevTree wherever only
+    the rows are needed, e.g. diff_trees().
+    """
+
+    def __init__(self, devtree, esm_time=None, host=None, saved=None):
+        """
+        Args:
+            devtree (list): datasource dicts in tree order
+            esm_time (str): ESM time (GMT) the tree was built at
+            host (str): ESM the tree came from
+            saved (float): unix time the snapshot was written
+        """
+        self.devtree = devtree
+        self.esm_time = esm_time
+        self.host = host
+        self.saved = saved
+
+    def __iter__(self):
+        return iter(self.devtree)
+
+    def __len__(self):
+        return len(self.devtree)
+
+
+class MappedSnapshot(object):
+    """
+    Read only view of a binary snapshot. Rows are decoded on access;
+    select() and values() mirror DevTree but read the saved indexes
+    instead of building them.
+    """
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): file written by save_snapshot()
+
+        Raises:
+            OSError if the file cannot be read
+            ValueError if it is not a binary snapshot
+        """
+        with open(filename, 'rb') as open_f:
+            self._mmap = mmap.mmap(open_f.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self._buf = memoryview(self._mmap)
+        self._views = {}
+        self._strings = {}
+        self._untimed_rows = None
+        try:
+            magic, version, meta_len = HEADER.unpack_from(self._mmap)
+            if magic != MAGIC or version not in BINARY_VERSIONS:
+                raise ValueError
+            meta = json.loads(bytes(self._buf[HEADER.size:
+                                              HEADER.size + meta_len])
+                              .decode('utf-8'))
+        except (struct.error, ValueError):
+            self.close()
+            raise ValueError('Not an esmcheckds2 snapshot: {}'
+                             .format(filename))
+        self._base = _align(HEADER.size + meta_len)
+        self._sections = meta['sections']
+        self.fields = [(field, kind) for field, kind in meta['fields']]
+        self.indexed_fields = tuple(meta['indexed'])
+        self.field_aliases = meta['aliases']
+        self.host = meta.get('esm')
+        self.esm_time = meta.get('esm_time')
+        self.saved = meta.get('saved')
+        self.rows = meta['rows']
+
+    def close(self):
+        for view in self._views.values():
+            if isinstance(view, memoryview):
+                view.release()
+        self._views = {}
+        self._buf.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.rows
+
+    def __iter__(self):
+        for pos in range(self.rows):
+            yield self.row(pos)
+
+    def _section(self, name):
+        """
+        Returns:
+            memoryview (or array on big endian hosts) of a section
+        """
+        view = self._views.get(name)
+        if view is None:
+            typecode, offset, count = self._sections[name]
+            start = self._base + offset
+            nbytes = count * struct.calcsize(typecode)
+            view = self._buf[start:start + nbytes].cast(typecode)
+            if sys.byteorder != 'little' and typecode != 'B':
+                view = array(typecode, view.tobytes())
+                view.byteswap()
+            self._views[name] = view
+        return view
+
+    def _string(self, sid):
+        string = self._strings.get(sid)
+        if string is None:
+            offs = self._section('str_offs')
+            data = self._section('str_data')
+            string = str(data[offs[sid]:offs[sid + 1]], 'utf-8')
+            self._strings[sid] = string
+        return string
+
+    def _string_id(self, value):
+        """
+        Returns:
+            id of value in the sorted string table or None
+        """
+        count = len(self._section('str_offs')) - 1
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < count and self._string(lo) == value:
+            return lo
+        return None
+
+    def _value(self, kind, raw):
+        if kind == INT:
+            return _MISSING if raw == NO_INT else raw
+        if raw == NO_VALUE:
+            return _MISSING
+        if raw == NULL_VALUE:
+            return None
+        if kind == JSON:
+            return json.loads(self._string(raw))
+        return self._string(raw)
+
+    def row(self, pos):
+        """
+        Returns:
+            datasource dict at tree position pos
+        """
+        row = {}
+        for field, kind in self.fields:
+            value = self._value(kind, self._section('col.' + field)[pos])
+            if value is not _MISSING:
+                row[field] = value
+        return row
+
+    def columns(self, fields):
+        """
+        Values of a few fields for every row, decoding only those
+        columns. Much cheaper than iterating the rows when only a few
+        fields are needed, e.g. by diff_trees().
+
+        Args:
+            fields (iterable): field names
+
+        Returns:
+            dict of field -> list of values in tree order, None where a
+            row lacks the field
+        """
+        kinds = dict(self.fields)
+        columns = {}
+        for field in fields:
+            kind = kinds.get(field)
+            if kind is None:
+                columns[field] = [None] * self.rows
+                continue
+            ids = self._section('col.' + field).tolist()
+            lookup = self._lookup(kind, set(ids))
+            for raw, value in lookup.items():
+                if value is _MISSING:
+                    lookup[raw] = None
+            columns[field] = list(map(lookup.__getitem__, ids))
+        return columns
+
+    def _lookup(self, kind, raws):
+        """
+        Decode many column values at once, slicing string table entries
+        straight out of the mmap instead of going through _string().
+
+        Returns:
+            dict of raw column value to value (_MISSING if missing)
+        """
+        if kind != STR:
+            return {raw: self._value(kind, raw) for raw in raws}
+        offs = self._section('str_offs').tolist()
+        base = self._base + self._sections['str_data'][1]
+        data = self._mmap
+        lookup = {}
+        for raw in raws:
+            if raw == NO_VALUE:
+                lookup[raw] = _MISSING
+            elif raw == NULL_VALUE:
+                lookup[raw] = None
+            else:
+                lookup[raw] = data[base + offs[raw]:
+                                   base + offs[raw + 1]].decode('utf-8')
+        return lookup
+
+    def _index(self, field):
+        prefix = 'index.{}.'.format(field)
+        return (self._section(prefix + 'keys'),
+                self._section(prefix + 'starts'),
+                self._section(prefix + 'perm'))
+
+    def _positions(self, field, value):
+        if field == 'last_before':
+            keys = self._section('time_keys')
+            end = bisect.bisect_left(keys, _epoch(value))
+            return set(self._section('time_pos')[:end])
+        if field == 'last_after':
+            keys = self._section('time_keys')
+            start = bisect.bisect_right(keys, _epoch(value))
+            return set(self._section('time_pos')[start:])
+        if field == 'never':
+            never = set(self._section('never'))
+            if value:
+                return never
+            return set(range(self.rows)) - never
+
+        field = self.field_aliases.get(field, field)
+        if field not in self.indexed_fields:
+            raise ValueError('Cannot select on field: {}'.format(field))
+        keys, starts, perm = self._index(field)
+        if not isinstance(value, (list, tuple, set, frozenset)):
+            value = [value]
+        positions = set()
+        for val in value:
+            if val is None:
+                # Missing and None are not indexed, like DevTree.select()
+                # matching both with None; scan the column instead.
+                column = self._section('col.' + field)
+                positions.update(pos for pos, sid in enumerate(column)
+                                 if sid >= NULL_VALUE)
+                continue
+            if not isinstance(val, str):
+                continue
+            sid = self._string_id(val)
+            if sid is None:
+                continue
+            key = bisect.bisect_left(keys, sid)
+            if key < len(keys) and keys[key] == sid:
+                positions.update(perm[starts[key]:starts[key + 1]])
+        return positions
+
+    def _select_positions(self, criteria):
+        if not criteria:
+            return None
+        matches = sorted((self._positions(field, value)
+                          for field, value in criteria.items()), key=len)
+        return matches[0].intersection(*matches[1:])
+
+    def select(self, **criteria):
+        """
+        Datasources matching every criterion; see DevTree.select().
+
+        Returns:
+            List of datasource dicts in tree order
+        """
+        positions = self._select_positions(criteria)
+        if positions is None:
+            return list(self)
+        return [self.row(pos) for pos in sorted(positions)]
+
+    def idle_counts(self, now, thresholds, group_by, **criteria):
+        """
+        Age histogram per group; see DevTree.idle_counts().
+        """
+        group_by = self.field_aliases.get(group_by, group_by)
+        kind = dict(self.fields)[group_by]
+        column = self._section('col.' + group_by)
+
+        def group(pos):
+            value = self._value(kind, column[pos])
+            return None if value is _MISSING else value
+
+        allowed = self._select_positions(criteria)
+        if allowed is None:
+            allowed = range(self.rows)
+        counts = {}
+        for pos in sorted(allowed):
+            key = group(pos)
+            if key not in counts:
+                counts[key] = [0] * (len(thresholds) + 2)
+            counts[key][0] += 1
+        for pos in self._section('never'):
+            if pos in allowed:
+                row = counts[group(pos)]
+                for col in range(1, len(row)):
+                    row[col] += 1
+        for pos in self._untimed():
+            if pos in allowed:
+                row = counts[group(pos)]
+                for col in range(1, len(row) - 1):
+                    row[col] += 1
+
+        time_keys = self._section('time_keys')
+        time_pos = self._section('time_pos')
+        bounds = [bisect.bisect_left(time_keys, _epoch(now - threshold))
+                  for threshold in thresholds]
+        bounds.append(0)
+        for level in range(len(thresholds), 0, -1):
+            for pos in time_pos[bounds[level]:bounds[level - 1]]:
+                if pos in allowed:
+                    row = counts[group(pos)]
+                    for col in range(1, level + 1):
+                        row[col] += 1
+        return counts
+
+    def _untimed(self):
+        """
+        Returns:
+            list of rows without a last time that are not never, i.e.
+            n/a or empty, in tree order. These are in neither the time
+            index nor never, so only the rows outside both are decoded.
+        """
+        from esmcheckds2.esmcheckds2 import no_last_time
+        if self._untimed_rows is None:
+            indexed = set(self._section('time_pos'))
+            indexed.update(self._section('never'))
+            kind = dict(self.fields).get('last_time')
+            untimed = []
+            for pos in range(self.rows):
+                if pos in indexed:
+                    continue
+                last_time = None
+                if kind is not None:
+                    last_time = self._value(
+                        kind, self._section('col.last_time')[pos])
+                if last_time is _MISSING or no_last_time(last_time):
+                    untimed.append(pos)
+            self._untimed_rows = untimed
+        return self._untimed_rows
+
+    def values(self, field):
+        """
+        Returns:
+            List of the distinct values of an indexed field
+        """
+        field = self.field_aliases.get(field, field)
+        if field not in self.indexed_fields:
+            raise ValueError('Cannot select on field: {}'.format(field))
+        keys, _, perm = self._index(field)
+        values = [self._string(sid) for sid in keys]
+        if len(perm) < self.rows:
+            values.append(None)
+        return values
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _epoch(stamp):
+    return calendar.timegm(stamp.timetuple())
+
+
+def _column_type(values):
+    kinds = {type(value) for value in values if value is not _MISSING}
+    # None is stored as NULL_VALUE, so it does not cost a string column
+    # its index.
+    if kinds <= {str, type(None)}:
+        return STR
+    if kinds == {int}:
+        return INT
+    return JSON
+
+
+def _pack(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed
+
+
+def _binary_snapshot(devtree, host, esm_time):
+    """
+    Returns:
+        bytes. devtree in the binary snapshot format
+    """
+    from esmcheckds2.esmcheckds2 import DevTree, parse_time
+    rows = list(devtree)
+    # Rows come in a handful of shapes; merge those, not every row.
+    fields = list(dict.fromkeys(field for shape in
+                                dict.fromkeys(tuple(row) for row in rows)
+                                for field in shape))
+    columns = [(field, [row.get(field, _MISSING) for row in rows])
+               for field in fields]
+    kinds = {field: _column_type(values) for field, values in columns}
+
+    dumped = {}
+
+    def dumps(value):
+        try:
+            return dumped[type(value), value]
+        except KeyError:
+            string = dumped[type(value), value] = json.dumps(value)
+            return string
+        except TypeError:
+            return json.dumps(value)
+
+    encoded = {}
+    for field, values in columns:
+        if kinds[field] == JSON:
+            encoded[field] = [value if value is _MISSING else dumps(value)
+                              for value in values]
+        elif kinds[field] == STR:
+            encoded[field] = values
+    strings = sorted({value for values in encoded.values()
+                      for value in values
+                      if value is not _MISSING and value is not None})
+    string_ids = {string: sid for sid, string in enumerate(strings)}
+    data = [string.encode('utf-8') for string in strings]
+    offs = [0]
+    for string in data:
+        offs.append(offs[-1] + len(string))
+
+    sections = [('str_offs', _pack('I', offs)),
+                ('str_data', array('B', b''.join(data)))]
+    column_ids = {}
+    for field, values in columns:
+        if kinds[field] == INT:
+            sections.append(('col.' + field, _pack(
+                'q', [NO_INT if value is _MISSING else value
+                      for value in values])))
+        else:
+            ids = column_ids[field] = [
+                NO_VALUE if value is _MISSING else
+                NULL_VALUE if value is None else string_ids[value]
+                for value in encoded[field]]
+            sections.append(('col.' + field, _pack('I', ids)))
+
+    stamps = []
+    never = []
+    for pos, row in enumerate(rows):
+        last_time = row.get('last_time')
+        if last_time == 'never':
+            never.append(pos)
+        elif isinstance(last_time, str) and last_time:
+            stamp = parse_time(last_time)
+            if stamp is not None:
+                stamps.append((_epoch(stamp), pos))
+    stamps.sort()
+    sections += [('time_keys', _pack('q', [key for key, _ in stamps])),
+                 ('time_pos', _pack('I', [pos for _, pos in stamps])),
+                 ('never', _pack('I', never))]
+
+    indexed = [field for field in DevTree.indexed_fields
+               if kinds.get(field) == STR]
+    for field in indexed:
+        ids = column_ids[field]
+        # Stable sort: rows sharing a value stay in tree order.
+        perm = sorted((pos for pos, sid in enumerate(ids)
+                       if sid < NULL_VALUE), key=ids.__getitem__)
+        keys = []
+        starts = []
+        for start, pos in enumerate(perm):
+            if not keys or ids[pos] != keys[-1]:
+                keys.append(ids[pos])
+                starts.append(start)
+        starts.append(len(perm))
+        prefix = 'index.{}.'.format(field)
+        sections += [(prefix + 'keys', _pack('I', keys)),
+                     (prefix + 'starts', _pack('I', starts)),
+                     (prefix + 'perm', _pack('I', perm))]
+
+    directory = {}
+    body = []
+    offset = 0
+    for name, packed in sections:
+        chunk = packed.tobytes()
+        directory[name] = [packed.typecode, offset, len(packed)]
+        padding = _align(len(chunk)) - len(chunk)
+        body.append(chunk + b'\0' * padding)
+        offset += len(chunk) + padding
+
+    meta = json.dumps({'esm': host,
+                       'esm_time': esm_time,
+                       'saved': time.time(),
+                       'rows': len(rows),
+                       'fields': [[field, kinds[field]] for field in fields],
+                       'indexed': indexed,
+                       'aliases': DevTree.field_aliases,
+                       'sections': directory}).encode('utf-8')
+    header = HEADER.pack(MAGIC, BINARY_VERSION, len(meta))
+    padding = _align(len(header) + len(meta)) - len(header) - len(meta)
+    return b''.join([header, meta, b'\0' * padding] + body)
+
+
+def save_snapshot(devtree, filename, host=None, fmt='binary'):
+    """
+    Write a built tree to filename. The file is replaced atomically so
+    a concurrent reader never sees it half written.
+
+    Args:
+        devtree (DevTree or Snapshot)
+        filename (str): destination file
+        host (str): ESM host, defaults to the tree's ESM
+        fmt (str): 'binary' or 'json'
+
+    Raises:
+        OSError if the file cannot be written
+    """
+    if host is None:
+        host = getattr(devtree, 'host', None)
+    if host is None:
+        host = getattr(getattr(devtree, 'esm', None), 'host', None)
+    if fmt == 'binary':
+        atomic_write(filename, _binary_snapshot(devtree, host,
+                                                devtree.esm_time), 0o600)
+        return
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'esm': host,
+                'esm_time': devtree.esm_time,
+                'saved': time.time(),
+                'datasources': list(devtree)}
+    atomic_write(filename, json.dumps(snapshot), 0o600)
+
+
+def _fresh_snapshot(filename, max_age):
+    """
+    Returns:
+        the snapshot in filename if it was saved less than max_age
+        seconds ago, otherwise None
+    """
+    try:
+        if time.time() - os.path.getmtime(filename) > max_age:
+            return None
+        snapshot = load_snapshot(filename)
+    except (OSError, ValueError):
+        return None
+    if snapshot.saved is None or time.time() - snapshot.saved > max_age:
+        return None
+    return snapshot
+
+
+def shared_snapshot(filename, max_age, build):
+    """
+    Single-flight tree loading for processes started at about the same
+    time against the same ESM.
+
+    A snapshot saved less than max_age seconds ago is returned as is.
+    Otherwise the first process to take the lock calls build() and
+    publishes the result to filename, while the others wait on the lock
+    and then read it instead of querying the ESM themselves.
+
+    Args:
+        filename (str): shared snapshot file; filename.lock is the lock
+        max_age (float): seconds a published snapshot stays current
+        build (callable): returns a freshly built DevTree
+
+    Returns:
+        DevTree if this process built it, otherwise MappedSnapshot
+    """
+    snapshot = _fresh_snapshot(filename, max_age)
+    if snapshot is not None:
+        return snapshot
+    with FileLock(filename + '.lock'):
+        snapshot = _fresh_snapshot(filename, max_age)
+        if snapshot is not None:
+            return snapshot
+        devtree = build()
+        try:
+            save_snapshot(devtree, filename)
+        except OSError:
+            print('Could not write to file: {}'.format(filename))
+        return devtree
+
+
+def load_snapshot(filename):
+    """
+    Args:
+        filename (str): file written by save_snapshot()
+
+    Returns:
+        MappedSnapshot for binary snapshots, otherwise Snapshot
+
+    Raises:
+        OSError if the file cannot be read
+        ValueError if it is not a snapshot
+    """
+    with open(filename, 'rb') as open_f:
+        binary = open_f.read(len(MAGIC)) == MAGIC
+    if binary:
+        return MappedSnapshot(filename)
+    with open(filename) as open_f:
+        snapshot = json.load(open_f)
+    if (not isinstance(snapshot, dict)
+            or snapshot.get('version') != SNAPSHOT_VERSION):
+        raise ValueError('Not an esmcheckds2 snapshot: {}'.format(filename))
+    return Snapshot(snapshot['datasources'], snapshot.get('esm_time'),
+                    snapshot.get('esm'), snapshot.get('saved'))
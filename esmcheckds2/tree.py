@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from esmcheckds2.esmcheckds2 import is_idle
+
+# Datasource fields copied onto each tree node.
+NODE_FIELDS = ('name', 'ds_id', 'desc_id', 'ds_ip', 'model', 'zone_name',
+               'last_time')
+
+
+def build_tree(devtree, selected=None, idle_before=None):
+    """
+    Nest the flat device tree as ESM -> receiver -> datasource -> client.
+
+    Parents come before their children in ESM order, so one pass with a
+    ds_id index links every device to its parent_id. Clients carry
+    their receiver as parent_id and are hung under the container they
+    follow instead. A second pass in reverse order rolls the counts up.
+
+    Args:
+        devtree (DevTree or MappedSnapshot)
+        selected (list): datasources to count, e.g. DevTree.select()
+                         output. Branches without any are left out.
+                         None counts every device.
+        idle_before (datetime): devices with a last time before this
+                                count as idle. Devices without a last
+                                time always do, as in the CLI rows.
+
+    Returns:
+        list of root nodes - dicts with NODE_FIELDS, the rolled up
+        datasources, idle and never counts, and children
+    """
+    keep = None
+    if selected is not None:
+        keep = {ds['ds_id'] for ds in selected}
+
+    by_id = {}
+    linked = []
+    roots = []
+    container = None
+    for ds in devtree:
+        node = {field: ds.get(field) for field in NODE_FIELDS}
+        node['datasources'] = node['idle'] = node['never'] = 0
+        if keep is None or ds.get('ds_id') in keep:
+            node['datasources'] = 1
+            if is_idle(ds.get('last_time'), idle_before):
+                node['idle'] = 1
+            if ds.get('last_time') == 'never':
+                node['never'] = 1
+        node['children'] = []
+
+        if ds.get('client') and container is not None:
+            parent = container
+        else:
+            container = node
+            parent = by_id.get(ds.get('parent_id'))
+            by_id.setdefault(ds.get('ds_id'), node)
+        (parent['children'] if parent else roots).append(node)
+        linked.append((node, parent))
+
+    for node, parent in reversed(linked):
+        if parent is not None:
+            parent['datasources'] += node['datasources']
+            parent['idle'] += node['idle']
+            parent['never'] += node['never']
+
+    if keep is not None:
+        for node, _ in linked:
+            node['children'] = [child for child in node['children']
+                                if child['datasources']]
+        roots = [root for root in roots if root['datasources']]
+    return roots
+
+
+def format_tree(roots, indent='  '):
+    """
+    Indented text form of build_tree() output. Devices with children
+    show their rolled up counts, leaves their last time.
+
+    Returns:
+        str
+    """
+    lines = []
+    stack = [(root, 0) for root in reversed(roots)]
+    while stack:
+        node, depth = stack.pop()
+        label = node['name'] or node['ds_id']
+        if node['ds_ip']:
+            label = '{} ({})'.format(label, node['ds_ip'])
+        if node['children']:
+            label = '{} [datasources: {}, idle: {}, never: {}]'.format(
+                label, node['datasources'], node['idle'], node['never'])
+            stack.extend((child, depth + 1)
+                         for child in reversed(node['children']))
+        elif node['last_time']:
+            label = '{} - {}'.format(label, node['last_time'])
+        lines.append(indent * depth + label)
+    return '\n'.join(lines)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+ESM request handling: retries, backoff and the concurrency limiter,
+against a scripted transport instead of an ESM.
+"""
+
+import pytest
+import requests
+from esmcheckds2.esmcheckds2 import ESM
+from esmcheckds2.limiter import AIMDLimiter
+
+CFG = {'esmhost': 'esm.example', 'esmuser': 'user', 'esmpass': 'pass'}
+
+
+def _response(status, body='', headers=None):
+    resp = requests.models.Response()
+    resp.status_code = status
+    resp._content = body.encode('utf-8')
+    resp.headers.update(headers or {})
+    resp.encoding = 'utf-8'
+    return resp
+
+
+def _ess(**pairs):
+    return 'Response=' + ''.join('{}%13{}%13%14'.format(key, value)
+                                 for key, value in pairs.items())
+
+
+class Transport(object):
+    """
+    Stands in for requests.post. Logins succeed; ESS calls get the
+    scripted replies in order, where an exception is raised instead of
+    returned.
+    """
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = []
+
+    def __call__(self, url, data=None, **kwargs):
+        if url.endswith('/login'):
+            return _response(201, headers={'Set-Cookie': 'JWTToken=abc',
+                                           'Xsrf-Token': 'xyz'})
+        self.calls.append(data)
+        reply = self.replies.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return reply
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    def install(*replies):
+        fake = Transport(*replies)
+        monkeypatch.setattr(requests, 'post', fake)
+        return fake
+    return install
+
+
+def _esm(**kwargs):
+    kwargs.setdefault('backoff', 0)
+    return ESM(CFG, **kwargs)
+
+
+def _read(esm):
+    return esm.post('MISC_READFILE', data={'FNAME': 'f', 'SPOS': '0',
+                                           'NBYTES': '0'})
+
+
+def test_retry_busy(transport):
+    fake = transport(_response(503, 'busy'),
+                     _response(200, _ess(FSIZE='1', BREAD='1', DATA='x')))
+    assert _read(_esm())['DATA'] == 'x'
+    assert len(fake.calls) == 2
+
+
+def test_retry_cut_off_body(transport):
+    fake = transport(requests.exceptions.ChunkedEncodingError('cut off'),
+                     _response(200, _ess(FSIZE='1', BREAD='1', DATA='x')))
+    assert _read(_esm())['DATA'] == 'x'
+    assert len(fake.calls) == 2
+
+
+def test_retries_exhausted(transport):
+    fake = transport(*[_response(503, 'busy')] * 3)
+    esm = _esm(retries=2)
+    with pytest.raises(SystemExit):
+        _read(esm)
+    assert len(fake.calls) == 3
+
+
+def test_creates_file_retried_when_busy(transport):
+    fake = transport(_response(503, 'busy'),
+                     _response(200, _ess(FTOKEN='tok1')))
+    resp = _esm().post('DS_GETDSCLIENTLIST', data={'DSID': '1',
+                                                   'SEARCH': ''})
+    assert resp['FTOKEN'] == 'tok1'
+    assert len(fake.calls) == 2
+
+
+@pytest.mark.parametrize('lost', [requests.exceptions.ReadTimeout,
+                                  requests.exceptions.ConnectionError])
+def test_creates_file_not_resent(transport, lost):
+    fake = transport(lost('lost'), _response(200, _ess(FTOKEN='tok2')))
+    with pytest.raises(SystemExit):
+        _esm().post('DS_GETDSCLIENTLIST', data={'DSID': '1', 'SEARCH': ''})
+    assert len(fake.calls) == 1
+
+
+@pytest.mark.parametrize('error', [
+    requests.exceptions.ChunkedEncodingError('cut off'),
+    requests.exceptions.InvalidURL('bad url'),
+    KeyboardInterrupt(),
+])
+def test_release_on_error(transport, error):
+    transport(error, error)
+    limiter = AIMDLimiter(initial=2, maximum=2)
+    esm = _esm(retries=0, limiter=limiter)
+    for _ in range(2):
+        with pytest.raises((SystemExit, type(error))):
+            _read(esm)
+    assert limiter.inflight == 0
+
+    transport(_response(200, _ess(FSIZE='1', BREAD='1', DATA='x')))
+    assert _read(esm)['DATA'] == 'x'
+    assert limiter.inflight == 0
+
+
+def test_backoff_honours_retry_after():
+    esm = ESM.__new__(ESM)
+    esm.backoff = 0
+    esm.max_backoff = 30
+    busy = _response(503, 'busy', {'Retry-After': '5'})
+    assert esm._backoff_delay(0, busy) == 5
+    busy = _response(503, 'busy', {'Retry-After': '120'})
+    assert esm._backoff_delay(0, busy) == 30
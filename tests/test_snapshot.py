@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot round trip: a tree saved with save_snapshot() and read
+back with load_snapshot() answers like the DevTree it was saved from.
+"""
+
+from datetime import datetime, timedelta
+import pytest
+from esmcheckds2.esmcheckds2 import DevTree
+from esmcheckds2.snapshot import MappedSnapshot, load_snapshot, save_snapshot
+
+NOW = datetime(2017, 10, 16, 20, 3, 17)
+
+
+def _device(desc_id, name, ds_id, zone='', last_time='', **fields):
+    device = {'desc_id': desc_id, 'name': name, 'ds_id': ds_id,
+              'ds_ip': '10.0.0.{}'.format(int(ds_id) % 256),
+              'type_id': '65', 'enabled': 'T', 'zone_name': zone,
+              'model': 'Linux', 'vendor': 'Unix', 'last_time': last_time}
+    device.update(fields)
+    return device
+
+
+def _devtree(devices):
+    """
+    DevTree built from already parsed devices, without an ESM.
+    """
+    tree = DevTree.__new__(DevTree)
+    tree.esm_time = '2017-10-16T20:03:17.0+0000'
+    tree.devtree = list(tree._insert_rec_info(devices))
+    tree._build_summary()
+    tree._build_indexes()
+    tree._build_time_index()
+    return tree
+
+
+@pytest.fixture
+def devtree():
+    return _devtree([
+        # Before the first receiver: parent_name and parent_id are None.
+        _device('3', 'orphan', '900', last_time='2017/10/16 19:50:00'),
+        _device('14', 'ESM-1', '1'),
+        _device('2', 'Receiver 1', '2'),
+        _device('3', 'web', '10', 'DMZ', '2017/10/16 19:50:00'),
+        _device('3', 'db', '11', 'Core', '08/16/2017 15:10:45',
+                enabled='F'),
+        _device('3', 'mail', '12', 'DMZ', 'never'),
+        _device('256', 'container', '13', 'DMZ', '', client=False),
+        _device('3', 'client-1', '14', 'Core', '2017/10/14 01:00:00',
+                client=True),
+        _device('2', 'Receiver 2', '3'),
+        _device('3', 'dns', '20', 'Core', '2017/10/16 20:00:00'),
+        _device('3', 'ntp', '21', '', 'n/a', desc='time server'),
+    ])
+
+
+@pytest.fixture
+def snapshot(devtree, tmp_path):
+    filename = str(tmp_path / 'tree.snap')
+    save_snapshot(devtree, filename, host='esm.example')
+    snapshot = load_snapshot(filename)
+    yield snapshot
+    snapshot.close()
+
+
+CRITERIA = [
+    {},
+    {'parent': 'ESM-1'},
+    {'parent': 'Receiver 1'},
+    {'parent_id': None},
+    {'parent': None},
+    {'zone': 'DMZ', 'enabled': 'T'},
+    {'zone': ['DMZ', 'Core']},
+    {'desc_id': '3', 'enabled': 'F'},
+    {'name': 'missing'},
+    {'never': True},
+    {'never': False, 'zone': 'Core'},
+    {'last_before': NOW - timedelta(days=1)},
+    {'last_after': NOW - timedelta(hours=1), 'zone': 'Core'},
+]
+
+
+def test_load_mapped(snapshot):
+    assert isinstance(snapshot, MappedSnapshot)
+    assert snapshot.host == 'esm.example'
+    assert snapshot.esm_time == '2017-10-16T20:03:17.0+0000'
+
+
+def test_rows(devtree, snapshot):
+    assert len(snapshot) == len(devtree.devtree)
+    assert list(snapshot) == devtree.devtree
+
+
+@pytest.mark.parametrize('criteria', CRITERIA)
+def test_select(devtree, snapshot, criteria):
+    assert snapshot.select(**criteria) == devtree.select(**criteria)
+
+
+@pytest.mark.parametrize('field', DevTree.indexed_fields)
+def test_values(devtree, snapshot, field):
+    assert set(snapshot.values(field)) == set(devtree.values(field))
+
+
+@pytest.mark.parametrize('group_by', ['zone', 'parent', 'desc_id'])
+@pytest.mark.parametrize('criteria', [{}, {'enabled': 'T'}])
+def test_idle_counts(devtree, snapshot, group_by, criteria):
+    thresholds = [timedelta(minutes=15), timedelta(hours=1),
+                  timedelta(days=1), timedelta(days=7)]
+    assert (snapshot.idle_counts(NOW, thresholds, group_by, **criteria)
+            == devtree.idle_counts(NOW, thresholds, group_by, **criteria))
+
+
+def test_columns(devtree, snapshot):
+    fields = ['ds_id', 'name', 'zone_name', 'client', 'desc', 'missing']
+    columns = snapshot.columns(fields)
+    for field in fields:
+        assert columns[field] == [ds.get(field) for ds in devtree.devtree]